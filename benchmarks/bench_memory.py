@@ -0,0 +1,74 @@
+# memory benchmark for the display pipeline
+#
+# Measures the peak Python/numpy allocation (tracemalloc) of one
+# `update_image` call on a synthetic 16-bit raw frame, both for a redraw
+# of an already loaded file (slider move) and for a cold load.
+#
+#   python benchmarks/bench_memory.py --size 4096
+
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import panel as pn
+from astropy.io import fits
+
+from fist.app import build_app
+
+
+def find_widget(layout, name):
+    for wdg in layout.select(pn.widgets.Widget):
+        if wdg.name == name:
+            return wdg
+    raise KeyError(name)
+
+
+def clear_cache():
+    try:
+        from fist.core.cache import _slice_cache
+    except ImportError:     # versions without a slice cache
+        return
+    _slice_cache.clear()
+
+
+def peak_mb(action):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    action()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024**2
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Peak allocation per update_image")
+    parser.add_argument("--size", type=int, default=4096, help="frame side in pixels")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    folder = Path(tempfile.mkdtemp(prefix="fist-bench-"))
+    rng = np.random.default_rng(1)
+    raw = rng.integers(0, 65535, (args.size, args.size), dtype=np.uint16)
+    fits.PrimaryHDU(raw).writeto(folder / "G-ESPRE.bench.fits")
+    frame_mb = raw.nbytes / 1024**2
+
+    layout = build_app("ESPRESSO", str(folder))
+    find_widget(layout, "File type").value = "guiding"
+    find_widget(layout, "Scan Input Folder").clicks += 1
+    vmin = find_widget(layout, "vmin %")
+
+    redraw, cold = [], []
+    for i in range(args.repeat):
+        redraw.append(peak_mb(lambda: setattr(vmin, "value", 2.0 + i)))
+        clear_cache()
+        cold.append(peak_mb(lambda: setattr(vmin, "value", 1.0 + i)))
+
+    print(f"frame: {args.size}x{args.size} uint16 ({frame_mb:.1f} MB on disk)")
+    print(f"redraw peak: {min(redraw):8.1f} MB  ({min(redraw)/frame_mb:.1f}x frame)")
+    print(f"cold   peak: {min(cold):8.1f} MB  ({min(cold)/frame_mb:.1f}x frame)")
+
+
+if __name__ == "__main__":
+    main()
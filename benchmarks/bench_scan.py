@@ -0,0 +1,65 @@
+# folder scan benchmark for the header index
+#
+# Times the file discovery + header indexing step of a folder scan for a
+# synthetic night of small FITS products: first scan, rescan in the same
+# process, and rescan after a restart (fresh process, persistent store).
+#
+#   python benchmarks/bench_scan.py --nfiles 5000
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+from fist.core.instruments import load_instrument
+from fist.core.loader import find_instrument_files
+from fist.core.index import FileIndex
+from fist.core.indexstore import IndexStore
+
+
+def make_night(folder, nfiles):
+    data = np.zeros((8, 8), dtype=np.float32)
+    for i in range(nfiles):
+        hdul = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data, name="SCIDATA")])
+        hdul[0].header["MJD-OBS"] = 60000 + i / nfiles
+        hdul.writeto(folder / f"r.ESPRE.{i:05d}_S2D_A.fits")
+
+
+def timed_scan(folder, index, store, instr, kw):
+    t0 = time.perf_counter()
+    files = [str(Path(f).resolve()) for f in find_instrument_files(folder, "S2D_A", instr)]
+    records = index.scan(files, keys=(kw,), store=store)
+    sorted(records, key=lambda f: records[f]["keys"].get(kw))
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Folder scan time with the header index")
+    parser.add_argument("--nfiles", type=int, default=5000)
+    args = parser.parse_args()
+
+    instr = load_instrument("ESPRESSO")
+    kw = instr["sort_key"]
+    folder = Path(tempfile.mkdtemp(prefix="fist-night-"))
+    db = Path(tempfile.mkdtemp(prefix="fist-cache-")) / "index.sqlite"
+    make_night(folder, args.nfiles)
+
+    index = FileIndex()
+    store = IndexStore(db)
+    first = timed_scan(folder, index, store, instr, kw)
+    warm = timed_scan(folder, index, store, instr, kw)
+    store.close()
+
+    restart = timed_scan(folder, FileIndex(), IndexStore(db), instr, kw)
+
+    print(f"{args.nfiles} files")
+    print(f"first scan            : {first:7.3f} s")
+    print(f"rescan (same process) : {warm:7.3f} s")
+    print(f"rescan (after restart): {restart:7.3f} s")
+
+
+if __name__ == "__main__":
+    main()
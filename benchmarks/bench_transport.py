@@ -0,0 +1,129 @@
+# browser update size benchmark for the image display
+#
+# Renders the ESPRESSO example frames and a synthetic KPF 2D frame through
+# `build_app` and records, per interaction, the document patch the server
+# would send to the browser: bytes on the wire (as is, and deflated as with
+# --websocket-compression-level 1) and the time to compute and serialize it.
+# Run for both image transports ("indexed" and "rgba").
+#
+#   python benchmarks/bench_transport.py --kpf-size 4080
+
+import argparse
+import shutil
+import tempfile
+import time
+import zlib
+from importlib.resources import files, as_file
+from pathlib import Path
+
+import numpy as np
+import panel as pn
+from astropy.io import fits
+from bokeh.document import Document
+from bokeh.events import RangesUpdate
+from bokeh.protocol import Protocol
+
+from fist.app import build_app
+from fist.core.instruments import INSTRUMENTS
+from fist.core.display import IMAGE_TRANSPORTS
+
+
+def find_widget(layout, name):
+    for wdg in layout.select(pn.widgets.Widget):
+        if wdg.name == name:
+            return wdg
+    raise KeyError(name)
+
+
+def make_kpf_frame(folder, size):
+    rng = np.random.default_rng(1)
+    frame = rng.normal(1000, 30, (size, size)).astype(np.float32)
+    hdul = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(frame, name="GREEN_CCD")])
+    hdul[0].header["MJD-OBS"] = 60000.0
+    hdul.writeto(folder / "KP.20250101.00000.00_2D.fits")
+
+
+def patch_size(events):
+    """Bytes of the PATCH-DOC message for a list of document events."""
+    if not events:
+        return 0, 0
+    msg = Protocol().create("PATCH-DOC", events)
+    parts = [msg.header_json.encode(), msg.metadata_json.encode(), msg.content_json.encode()]
+    parts += [buf.to_bytes() for buf in msg.buffers]
+    raw = sum(len(p) for p in parts)
+    deflated = sum(len(zlib.compress(p, 1)) for p in parts)
+    return raw, deflated
+
+
+def measure(doc, action):
+    events = []
+    doc.callbacks.on_change(events.append)
+    t0 = time.perf_counter()
+    action()
+    raw, deflated = patch_size(events)
+    dt = time.perf_counter() - t0
+    doc.callbacks._change_callbacks.clear()
+    return raw, deflated, dt
+
+
+def run_frame(label, instrument, folder, filetype, transport):
+    INSTRUMENTS[instrument]["image_transport"] = transport
+    # start on an empty folder, so the first display happens in the document
+    layout = build_app(instrument, tempfile.mkdtemp(prefix="fist-empty-"))
+    doc = Document()
+    layout.server_doc(doc)
+    fig = next(p.object for p in layout.select(pn.pane.Bokeh)
+               if "rangesupdate" in p.object._event_callbacks)
+
+    def pan(frac):
+        x0, x1, y0, y1 = fig.x_range.start, fig.x_range.end, fig.y_range.start, fig.y_range.end
+        dx = (x1 - x0) * frac
+        fig._trigger_event(RangesUpdate(fig, x0=x0 + dx, x1=x1 + dx, y0=y0, y1=y1))
+
+    def zoom(factor):
+        x0, x1, y0, y1 = fig.x_range.start, fig.x_range.end, fig.y_range.start, fig.y_range.end
+        cx, cy, hw, hh = (x0 + x1) / 2, (y0 + y1) / 2, (x1 - x0) / 2 / factor, (y1 - y0) / 2 / factor
+        fig._trigger_event(RangesUpdate(fig, x0=cx - hw, x1=cx + hw, y0=cy - hh, y1=cy + hh))
+
+    vmin = find_widget(layout, "vmin %")
+    steps = [
+        ("first display", lambda: (setattr(find_widget(layout, "File type"), "value", filetype),
+                                   setattr(find_widget(layout, "Input folder"), "value", str(folder)),
+                                   setattr(find_widget(layout, "Scan Input Folder"), "clicks", 1))),
+        ("vmin change", lambda: setattr(vmin, "value", vmin.value + 1)),
+        ("colormap change", lambda: setattr(find_widget(layout, "Colormap"), "value", "gray")),
+        ("small pan", lambda: pan(0.02)),
+        ("zoom x4", lambda: zoom(4)),
+        ("cut overlay move", lambda: setattr(find_widget(layout, "x1"), "value", 10)),
+    ]
+    find_widget(layout, "Show cuts").value = True
+
+    for name, action in steps:
+        raw, deflated, dt = measure(doc, action)
+        print(f"{label:<18} {transport:<8} {name:<17} {raw/1024:10.1f} {deflated/1024:10.1f} {dt*1e3:9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes and latency per browser update")
+    parser.add_argument("--kpf-size", type=int, default=4080, help="synthetic KPF frame side")
+    args = parser.parse_args()
+
+    folder = Path(tempfile.mkdtemp(prefix="fist-bench-"))
+    with as_file(files("fist.static")) as p:
+        for fn in Path(p).glob("*.fits"):
+            shutil.copy(fn, folder)
+    make_kpf_frame(folder, args.kpf_size)
+
+    frames = [
+        ("ESPRESSO CCF", "ESPRESSO", "CCF_A"),
+        ("ESPRESSO guiding", "ESPRESSO", "guiding"),
+        (f"KPF 2D {args.kpf_size}", "KPF", "2D"),
+    ]
+    print(f"{'frame':<18} {'mode':<8} {'update':<17} {'KiB':>10} {'KiB defl':>10} {'ms':>9}")
+    for label, instrument, filetype in frames:
+        for transport in IMAGE_TRANSPORTS:
+            run_frame(label, instrument, folder, filetype, transport)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# load test of the fist server with simulated viewers
+#
+# Starts `fist` on a folder of synthetic KPF L2-named frames (or connects to a
+# running server with --url), then opens one bokeh.client session per
+# simulated viewer. Every viewer steps through the frames and moves the
+# "vmin %" slider, waiting each time for the new image to arrive, and the
+# latency of each interaction is recorded. Compare --num-procs 1 and N to
+# see the effect of several server processes sharing the decode store.
+#
+#   python benchmarks/load_test.py --clients 8 --num-procs 1
+#   python benchmarks/load_test.py --clients 8 --num-procs 4
+#   python benchmarks/load_test.py --url http://host:5006/FIST-KPF --clients 16
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from pathlib import Path
+
+import bokeh
+import numpy as np
+import panel.models     # noqa: F401 (registers Panel's Bokeh models for client documents)
+from astropy.io import fits
+from bokeh.client import pull_session
+from bokeh.models import ColumnDataSource, Slider
+
+# bokeh.client has no public "process messages until" call: wait_for drives
+# the connection through these private members of ClientConnection, which
+# exist in bokeh 3.2 to 3.9 (the versions this was run with)
+CLIENT_INTERNALS = ("_loop_until", "_protocol", "io_loop", "send_message")
+
+# longest wait for all viewers to be connected before they start together
+START_TIMEOUT = 120
+
+
+def make_frames(folder, n, size):
+    rng = np.random.default_rng(1)
+    for i in range(n):
+        frame = rng.normal(1000, 30, (size, size)).astype(np.float32)
+        hdul = fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(frame, name="GREEN_CCD")])
+        hdul[0].header["MJD-OBS"] = 60000.0 + i
+        # named as L2, the file type shown at startup
+        hdul.writeto(folder / f"KP.20250101.{i:05d}.00_L2.fits")
+
+
+def start_server(folder, port, num_procs):
+    cmd = [sys.executable, "-m", "fist.cli", "--instrument", "KPF", "--folder", str(folder),
+           "--port", str(port), "--num-procs", str(num_procs), "--no-show",
+           "--scratch-dir", str(Path(folder) / "scratch")]
+    # own process group: --num-procs forks workers that must be stopped too
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+    url = f"http://localhost:{port}/FIST-KPF"
+    for _ in range(300):
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return proc, url
+        except OSError:
+            time.sleep(0.1)
+    stop_server(proc)
+    raise RuntimeError("server did not start")
+
+
+def stop_server(proc):
+    """Stop the server and all its worker processes."""
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+
+def client_connection(session):
+    """The session's ClientConnection, checked for the private members wait_for uses."""
+    conn = getattr(session, "_connection", None)
+    missing = [a for a in CLIENT_INTERNALS if not hasattr(conn, a)]
+    if missing:
+        raise RuntimeError(f"bokeh {bokeh.__version__} client lacks {', '.join(missing)}: "
+                           "this load test needs bokeh 3.2 to 3.9")
+    return conn
+
+
+def wait_for(session, predicate, timeout):
+    """Process server messages until predicate() is true (or timeout)."""
+    conn = client_connection(session)
+    expired = []
+
+    def expire():
+        # the client loop only checks between messages: ask for a reply so
+        # it stops cleanly (stopping it mid-read would split the stream)
+        expired.append(True)
+        conn.io_loop.add_callback(conn.send_message, conn._protocol.create("SERVER-INFO-REQ"))
+
+    handle = conn.io_loop.call_later(timeout, expire)
+    conn._loop_until(lambda: bool(expired) or predicate())
+    conn.io_loop.remove_timeout(handle)
+    return predicate()
+
+
+def image_source(doc):
+    for m in doc.models:
+        if isinstance(m, ColumnDataSource) and "image" in m.data:
+            return m
+    return None
+
+
+def slider(doc, title):
+    return next(m for m in doc.models if isinstance(m, Slider) and m.title == title)
+
+
+def viewer(url, actions, timeout, latencies, errors, start):
+    session = None
+    try:
+        session = pull_session(url=url)
+        doc = session.document
+        # the first display is rendered in the background after the page is built
+        if not wait_for(session, lambda: image_source(doc) is not None, timeout):
+            raise RuntimeError("no image")
+        start.wait(timeout=START_TIMEOUT)
+
+        vmin, index = slider(doc, "vmin %"), slider(doc, "Index")
+        for k in range(actions):
+            src = image_source(doc)
+            before = src.data["image"]
+            t0 = time.perf_counter()
+            if k % 2:
+                vmin.value = 1.0 + (k % 10)
+            else:
+                # next frame, wrapping around: the value always changes
+                n = int(index.end - index.start + 1)
+                index.value = index.start + (index.value - index.start + 1) % n
+            if wait_for(session, lambda: image_source(doc).data["image"] is not before, timeout):
+                latencies.append(time.perf_counter() - t0)
+            else:
+                errors.append("timeout")
+    except threading.BrokenBarrierError:
+        errors.append("another viewer failed before the start")
+    except Exception as e:
+        # release the viewers waiting for this one at the start
+        start.abort()
+        errors.append(f"{type(e).__name__}: {e}")
+    finally:
+        if session is not None:
+            session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated viewers of a fist server")
+    parser.add_argument("--url", type=str, default=None, help="running server (default: start one)")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--actions", type=int, default=20, help="interactions per client")
+    parser.add_argument("--num-procs", type=int, default=1, help="server processes (when started here)")
+    parser.add_argument("--frames", type=int, default=6)
+    parser.add_argument("--size", type=int, default=2048, help="synthetic frame side")
+    parser.add_argument("--port", type=int, default=5106)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="fist-load-") as tmp:
+        proc = None
+        url = args.url
+        if url is None:
+            # frames and the server's scratch store, removed on exit
+            make_frames(Path(tmp), args.frames, args.size)
+            proc, url = start_server(tmp, args.port, args.num_procs)
+        try:
+            latencies, errors = [], []
+            start = threading.Barrier(args.clients)
+            threads = [threading.Thread(target=viewer, args=(url, args.actions, args.timeout,
+                                                             latencies, errors, start))
+                       for _ in range(args.clients)]
+            t0 = time.perf_counter()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            wall = time.perf_counter() - t0
+        finally:
+            if proc is not None:
+                stop_server(proc)
+
+    lat = np.array(latencies) * 1e3
+    print(f"{args.clients} clients x {args.actions} interactions, "
+          f"server processes: {args.num_procs if proc is not None else '?'}")
+    if lat.size:
+        p50, p90, p99 = np.percentile(lat, [50, 90, 99])
+        print(f"latency ms: p50 {p50:.0f}  p90 {p90:.0f}  p99 {p99:.0f}  max {lat.max():.0f}")
+    print(f"{lat.size} updates in {wall:.1f} s ({lat.size / wall:.1f} updates/s), "
+          f"{len(errors)} errors")
+    for e in sorted(set(errors)):
+        print("  ", e)
+
+
+if __name__ == "__main__":
+    main()
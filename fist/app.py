@@ -1,5 +1,6 @@
 # main entry for fist panel app
 
+import io
 from pathlib import Path
 import numpy as np
 
@@ -7,24 +8,36 @@ import panel as pn
 
 
 from bokeh.models import ColumnDataSource
+from bokeh.events import RangesUpdate
 
-from fist.core.state import _state
-from fist.core.loader import  load_image_slice
+from fist.core.state import SessionState
 from fist.core.instruments import load_instrument
 from fist.core.sessionmng import (
-    scan_folder_impl, update_extensions_impl, update_sourcelets_impl, update_idx_impl,
-    autofetch_tick_impl, current_arr
+    scan_folder_params, collect_folder_files, apply_folder_scan,
+    update_extensions_impl, update_sourcelets_impl, update_idx_impl,
+    autofetch_params, autofetch_poll, apply_autofetch, autofetch_stop_impl,
+    stack_files_impl, arith_params_impl
 )
-from fist.core.scaling import percentile_clip
-from fist.core.transforms import apply_transform
-from fist.core.display import make_image_figure, set_image
+from fist.core.display import make_image_figure, show_image
+from fist.core.pipeline import RenderPipeline
+from fist.core.pyramid import DEFAULT_VIEW_PIXELS
 from fist.core.layout import build_widgets, assemble_layout
-from fist.tools.arithmetic import compute_arithmetic
-from fist.tools.analysis import update_cut_plot, compute_region_stats
-from fist.tools.header import update_header_impl, apply_header_filter_impl
+from fist.core.workers import _runner, Debouncer, RenderScheduler
+from fist.core.prefetch import Prefetcher
+from fist.core.tracing import _tracer, traced, format_trace_summary
+from fist.tools.analysis import compute_region_stats
+from fist.tools.header import (
+    read_header_cards, show_header_cards, show_header_error, show_header_page,
+    apply_header_filter_impl, SEARCH_DEBOUNCE_MS, PAGE_DEBOUNCE_MS
+)
 
 
-def build_app(instrument_name, start_folder):
+def build_app(instrument_name, start_folder, diagnostics=False):
+    """
+    Build the viewer for one session: its widgets, state, render pipeline
+    and callbacks. Serve it through `app_factory` so that every browser
+    connection gets its own. `diagnostics` adds the stage timing panel.
+    """
 
     pn.extension()
     
@@ -34,8 +47,8 @@ def build_app(instrument_name, start_folder):
     
     # load instrument config
     instr = load_instrument(instrument_name)
-    # copying instrument image transform starting state
-    _state["transform"] = instr["transform"].copy()
+    # this session's state, starting from the instrument's image transform
+    state = SessionState.from_instrument(instr)
     
     # If CLI folder not provided → use the instrument's default
     if start_folder is None:
@@ -52,11 +65,29 @@ def build_app(instrument_name, start_folder):
 
     cut_src = w["cut_src"]
 
-    layout = assemble_layout(w, image_pane, instr)
+    layout = assemble_layout(w, image_pane, instr, diagnostics=diagnostics)
 
     # Source for region outline (circle or square)
     w["region_src"] = ColumnDataSource(data=dict(xs=[], ys=[]))
 
+    # warms the slice cache around the index slider
+    prefetcher = Prefetcher(depth=instr["prefetch_depth"])
+
+    # memoized load -> arithmetic -> scaling -> transform -> colormap stages
+    pipeline = RenderPipeline()
+
+    # size of the quick look shown while a new frame is decoded
+    preview_pixels = instr["preview_pixels"]
+
+    # above this size, quantiles and region statistics are streamed
+    stream_bytes = int(instr["stream_stats_mb"] * 1024**2)
+
+    # last outputs pushed to the page, to skip resending unchanged data
+    shown = dict(arr=None, image=None, palette=None, cut=None, header=None)
+
+    # visible data range of the image figure, (x0, x1, y0, y1), None = all
+    view = dict(ranges=None)
+
     # -------------------------------
     # Autofetch
     # -------------------------------
@@ -65,27 +96,54 @@ def build_app(instrument_name, start_folder):
     autofetch_cb = None
 
     def autofetch_tick():
-        autofetch_tick_impl(w, instr)
-        update_extensions()
-        update_image()
+        # skip the tick while the previous poll is still running
+        if _runner.busy("autofetch"):
+            return
+        _runner.submit("autofetch", autofetch_poll, autofetch_params(w, state), instr,
+                       on_done=apply_autofetch_result)
+
+    def apply_autofetch_result(result):
+        params = render_params()
+        if result and result["files"] and params is not None and w["autofetch"].value:
+            # start decoding the newest arrival right away
+            prefetcher.warm(result["files"][-1], params["ename"], params["src_idx"], params["dtype"])
+        if apply_autofetch(w, state, result):
+            update_image()
 
     # -------------------------------
     # Core update logic
     # -------------------------------
 
     def update_extensions(event=None):
-        update_extensions_impl(w, _state)
-        update_sourcelets()
+        ename = w["ext_sel"].value
+        update_extensions_impl(w, state)
+        if w["ext_sel"].value == ename:
+            # otherwise the ext_sel watcher updates them
+            update_sourcelets()
 
 
     def update_sourcelets(event=None):
         update_sourcelets_impl(w, instr)
 
-    def apply_header_filter(event=None):
-        apply_header_filter_impl(w)
+    # filter once typing pauses, not on every keystroke
+    apply_header_filter = Debouncer(lambda: apply_header_filter_impl(w), SEARCH_DEBOUNCE_MS)
+    show_page = Debouncer(lambda: show_header_page(w), PAGE_DEBOUNCE_MS)
+
+    def update_header(event=None, sig=None):
+        fname = w["file_sel"].value
+        ext = w["hdr_ext"].value
+        if not fname or ext is None:
+            return
+
+        def done(cards):
+            show_header_cards(w, cards)
+            shown["header"] = (sig, ext) if sig is not None else None
 
-    def update_header(event=None):
-        update_header_impl(w)
+        _runner.submit(
+            "header", read_header_cards, fname, ext,
+            on_done=done,
+            on_error=lambda e: show_header_error(w, e),
+        )
 
 
     # -------------------------------
@@ -93,7 +151,12 @@ def build_app(instrument_name, start_folder):
     # -------------------------------
 
     def scan_folder(event=None):
-        scan_folder_impl(w, instr, _state)
+        _runner.submit("scan", collect_folder_files, scan_folder_params(w), instr,
+                       on_done=apply_scan,
+                       on_error=lambda e: setattr(w["info_state"], "object", f"Scan error: {e}"))
+
+    def apply_scan(result):
+        apply_folder_scan(w, state, result)
         update_extensions()
         update_image()
 
@@ -101,6 +164,12 @@ def build_app(instrument_name, start_folder):
     def update_idx(event=None):
         update_idx_impl(w)
         update_image()
+        params = render_params()
+        if params is not None:
+            prefetcher.on_index(
+                list(w["file_sel"].options.values()), w["file_idx"].value - 1,
+                params["ename"], params["src_idx"], params["dtype"],
+            )
 
 
     def update_slider_from_dropdown(event=None):
@@ -112,6 +181,13 @@ def build_app(instrument_name, start_folder):
             pass
 
 
+    def on_file_change(event=None):
+        # one watcher: the image itself follows through the index slider
+        update_slider_from_dropdown()
+        update_extensions()
+        update_header()
+
+
     # -------------------------------
     # handler functions
     # -------------------------------
@@ -136,6 +212,8 @@ def build_app(instrument_name, start_folder):
             if autofetch_cb is not None:
                 autofetch_cb.stop()
                 autofetch_cb = None
+            autofetch_stop_impl(state)
+            prefetcher.cancel()
 
     def toggle_section(toggle_widget, section_widget):
         """General show/hide handler for collapsible sections."""
@@ -189,18 +267,26 @@ def build_app(instrument_name, start_folder):
             w["region_src"].data = dict(xs=[], ys=[])
             return
 
+        # add multi_line glyph once
+        if not getattr(image_fig, "_region_added", False):
+            image_fig.multi_line(
+                xs="xs", ys="ys",
+                source=w["region_src"],
+                line_color="cyan", line_width=2
+            )
+            image_fig._region_added = True
+
         shape = w["region_shape"].value   # Circle | Square
         x = float(w["region_x"].value)
         y = float(w["region_y"].value)
         d = float(w["region_d"].value)
 
-        arr = current_arr(w, instr, _state)
+        # the array last rendered (arithmetic result if active)
+        arr = shown["arr"]
         if arr is None:
             w["region_stats"].object = "No array loaded."
             return
 
-        h, wimg = arr.shape  # height, width
-
         # ---------------------------------
         # 1) Build outline for display
         # ---------------------------------
@@ -217,77 +303,155 @@ def build_app(instrument_name, start_folder):
             w["region_src"].data = dict(xs=[xs], ys=[ys])
 
         # ---------------------------------
-        # 2) Build mask for statistics
+        # 2) Statistics on the bounding box, with fractional pixel weights
         # ---------------------------------
-        yy, xx = np.indices(arr.shape)
+        w["region_stats"].object = compute_region_stats(arr, (shape, x, y, d),
+                                                          stream_bytes=stream_bytes)
 
-        if shape == "Circle":
-            mask = (xx - x)**2 + (yy - y)**2 <= d**2
-
-        else:  # Square
-            mask = (xx >= x) & (xx <= x+d) & (yy >= y) & (yy <= y+d)
 
-        # Avoid invalid indices if user inputs go outside image
-        mask = mask & (xx >= 0) & (xx < wimg) & (yy >= 0) & (yy < h)
-
-        # ---------------------------------
-        # 3) Compute statistics
-        # ---------------------------------
-        stats_text = compute_region_stats(arr, mask)
-        w["region_stats"].object = stats_text
-
-
-    def update_image(event=None):
+    def render_params():
+        """Snapshot of the widget values used by a render (document thread)."""
         fname = w["file_sel"].value
         ename = w["ext_sel"].value
 
         # allows PRIMARY or unnamed extensions
         if not fname or ename is None:
-            return
+            return None
 
         src_idx=None
         if w["src_sel"].visible:
-            lbl = w["src_sel"].value
-            sourcelet_names = instr["sourcelets"]
-            src_idx = next((i for i,nm in sourcelet_names.items() if nm==lbl), 0)
+            # options are listed in plane order (see update_sourcelets_impl)
+            src_idx = w["src_sel"].options.index(w["src_sel"].value)
+
+        try:
+            arith = arith_params_impl(w)
+        except ValueError as e:
+            w["info_file"].object = f"Arithmetic error: {e}"
+            return None
+
+        stack = None
+        if w["stack_on"].value:
+            files = stack_files_impl(w)
+            if files:
+                stack = (tuple(files), w["stack_method"].value, float(w["stack_sigma"].value or 3.0))
+
+        cut = None
+        if w["cuts_toggle"].value:
+            cut = (float(w["x1"].value), float(w["y1"].value),
+                   float(w["x2"].value), float(w["y2"].value))
+
+        return dict(
+            fname=fname, ename=ename, src_idx=src_idx,
+            dtype=instr["working_dtype"],
+            stack=stack,
+            arith=arith,
+            vmin=w["vmin"].value, vmax=w["vmax"].value,
+            gamma=w["gamma"].value, stretch=w["stretch"].value,
+            contrast=w["contrast"].value,
+            quantiles=w["quantiles"].value,
+            transform=dict(state.transform),
+            cmap=w["cmap"].value,
+            lut_size=instr["lut_size"],
+            stream_bytes=stream_bytes,
+            transport=instr["image_transport"],
+            viewport=viewport(),
+            cut=cut,
+            cut_width=int(w["cut_width"].value or 1),
+        )
+
 
-        arr_base = load_image_slice(fname, ename, src_idx)
-        if arr_base is None:
-            w["info_file"].object = "Cannot load image."
+    def viewport():
+        """Visible range and figure size in screen pixels, for the pyramid level."""
+        if view["ranges"] is None:
+            return None
+        try:
+            px = (image_fig.inner_width, image_fig.inner_height)
+        except ValueError:
+            # not reported by the browser yet
+            px = DEFAULT_VIEW_PIXELS
+        return view["ranges"] + px
+
+
+    def on_ranges(event):
+        """Pan/zoom: refine the image for the new view (only sends if the window changed)."""
+        if None in (event.x0, event.x1, event.y0, event.y1):
             return
+        view["ranges"] = (event.x0, event.x1, event.y0, event.y1)
+        update_image()
 
-        # ---- Arithmetic ----
-        if w["arith_on"].value and w["arith_file"].value != "None":
-            arr2 = load_image_slice(w["arith_file"].value, ename, src_idx)
-            if arr2 is None:
-                w["info_file"].object="Arithmetic error"
-                return
-            arr, nan_warn = compute_arithmetic(arr_base, arr2, w["arith_op"].value)
-            _state["arith_active"] = True
-            _state["arith_arr"] = arr
-            _state["arith_nan_warning"] = nan_warn
-        else:
-            arr = arr_base
-            _state["arith_active"] = False
-            _state["arith_arr"] = None
-            _state["arith_nan_warning"] = False
-
-        # ---- Scaling ----
-        arr_s = percentile_clip(
-            arr,
-            w["vmin"].value, w["vmax"].value,
-            w["gamma"].value,
-            stretch=w["stretch"].value,
-            contrast=w["contrast"].value
-        )
 
-        # ---- Transform ----
-        arr_s = apply_transform(arr_s, _state["transform"])
+    def run_render():
+        params = render_params()
+        if params is None:
+            return
+        # load and compute in the background; newer requests supersede this one
+        _runner.submit("render", pipeline.run, params, on_done=apply_render,
+                       on_error=lambda e: setattr(w["info_file"], "object", f"Render error: {e}"))
+        if preview_pixels:
+            # a frame still to be decoded is shown from a subsample meanwhile
+            _runner.submit("preview", pipeline.preview, params, preview_pixels,
+                           on_done=apply_preview)
+
+    doc = pn.state.curdoc
+
+    # widget changes only ask for a render: bursts of them (slider drags,
+    # one change cascading through several widgets) run one render per frame
+    scheduler = RenderScheduler(run_render, busy=lambda: _runner.busy("render", doc))
+    update_image = scheduler.request
+
+    # region statistics are recomputed once per frame while the region is dragged
+    region_scheduler = RenderScheduler(lambda: update_region_overlay())
+
+
+    @traced("app")
+    def apply_preview(res):
+        """Show a preview until its full render arrives (document thread)."""
+        if res is None or not _runner.busy("render", doc):
+            # nothing to preview, or the full render is already done
+            return
+        image, palette = res["image"], res["palette"]
+        reset = show_image(image_fig, image, shape=res["shape"], palette=palette)
+        shown["image"], shown["palette"] = image, palette
+        pipeline.mark_shown(image)
+        if reset and view["ranges"] is not None:
+            view["ranges"] = None
+            update_image()
+        h, wd = res["shape"]
+        w["info_file"].object = f"Reading {Path(res['fname']).name} ({wd} x {h}), preview..."
+
+
+    @traced("app")
+    def apply_render(res):
+        """Push a finished render to the page (document thread)."""
+        if "error" in res:
+            w["info_file"].object = res["error"]
+            return
+
+        arr = shown["arr"] = res["arr"]
+        state.arith_active = res["arith_active"]
+        state.arith_arr = arr if res["arith_active"] else None
+        state.arith_nan_warning = res["arith_nan_warning"]
 
         # ---- Display ----
-        set_image(image_fig, arr_s, w["cmap"].value)
-        
-        w["info_file"].object = f"Read {Path(fname).name} ({arr_s.shape[1]} x {arr_s.shape[0]})."
+        image, palette = res["image"], res["palette"]
+        if image is not shown["image"] or palette is not shown["palette"]:
+            reset = show_image(image_fig, image, extent=res["extent"], shape=res["shape"],
+                               palette=palette)
+            shown["image"], shown["palette"] = image, palette
+            pipeline.mark_shown(image)
+            if reset and view["ranges"] is not None:
+                # new image geometry, axes now show all of it: rerender for that view
+                view["ranges"] = None
+                update_image()
+
+        stats = scheduler.stats()
+        w["render_info"].object = f"Renders: {stats['executed']} of {stats['requested']} requested"
+
+        h, wd = res["shape"]
+        if res["nstack"]:
+            w["info_file"].object = f"Stack of {res['nstack']} frames ({wd} x {h})."
+        else:
+            w["info_file"].object = f"Read {Path(res['fname']).name} ({wd} x {h})."
 
         # ---- Cuts ----
         if w["cuts_toggle"].value:
@@ -307,12 +471,10 @@ def build_app(instrument_name, start_folder):
                 image_fig._cuts_added = True
 
             # Update plot and overlay
-            update_cut_plot(
-                arr,
-                float(w["x1"].value), float(w["y1"].value),
-                float(w["x2"].value), float(w["y2"].value),
-                cut_src,
-            )
+            if res["cut"] is not None and res["cut"] is not shown["cut"]:
+                dist, vals = res["cut"]
+                cut_src.data = dict(x=dist, y=vals)
+                shown["cut"] = res["cut"]
             update_cut_overlay()
 
         else:
@@ -321,25 +483,36 @@ def build_app(instrument_name, start_folder):
             w["cut_points_src"].data = dict(x=[], y=[])
 
         # ---- Region ----
-        if w["region_toggle"].value:
-            # add multi_line glyph once
-            if not getattr(image_fig, "_region_added", False):
-                image_fig.multi_line(
-                    xs="xs", ys="ys",
-                    source=w["region_src"],
-                    line_color="cyan", line_width=2
-                )
-                image_fig._region_added = True
-
-            # update overlay (function ensures proper show/clear)
-            update_region_overlay()
-        else:
-            # panel hidden -> ensure overlay cleared
-            w["region_src"].data = dict(xs=[], ys=[])
+        # statistics follow the new array (function ensures proper show/clear)
+        update_region_overlay()
 
         # ---- Header ----
-        if w["hdr_toggle"].value:
-            update_header()
+        # only reread the header when the file (or its contents) changed
+        if w["hdr_toggle"].value and shown["header"] != (res["sig"], w["hdr_ext"].value):
+            update_header(sig=res["sig"])
+
+        update_diagnostics()
+
+
+    # -------------------------------
+    # Diagnostics
+    # -------------------------------
+
+    def update_diagnostics(event=None):
+        if diagnostics and w["diag_toggle"].value:
+            w["diag_table"].object = format_trace_summary(_tracer.summary())
+
+    def on_diag_record(event):
+        _tracer.enabled = w["diag_on"].value
+        update_diagnostics()
+
+    def on_diag_clear(event):
+        _tracer.clear()
+        update_diagnostics()
+
+    w["diag_on"].value = _tracer.enabled
+    w["diag_json"].callback = lambda: io.StringIO(_tracer.to_json())
+    w["diag_chrome"].callback = lambda: io.StringIO(_tracer.to_chrome_trace())
 
 
     # -------------------------------
@@ -348,9 +521,7 @@ def build_app(instrument_name, start_folder):
 
     w["refresh"].on_click(scan_folder)
     w["file_idx"].param.watch(update_idx, "value")
-    w["file_sel"].param.watch(update_slider_from_dropdown, "value")
-
-    w["file_sel"].param.watch(update_extensions, "value")
+    w["file_sel"].param.watch(on_file_change, "value")
     w["ext_sel"].param.watch(lambda e: (update_sourcelets(), update_image()), "value")
     w["src_sel"].param.watch(update_image, "value")
 
@@ -358,7 +529,7 @@ def build_app(instrument_name, start_folder):
     w["autofetch"].param.watch(on_autofetch_toggle, "value")
 
     # key=key to freeze the value inside the lambda 
-    for key in ('disp', 'trans', 'arith', 'cuts', 'region', 'hdr'):
+    for key in ('disp', 'trans', 'arith', 'cuts', 'region', 'hdr', 'diag'):
         w[f"{key}_toggle"].param.watch(
             lambda evt, key=key: toggle_section(w[f"{key}_toggle"], w[f"{key}_section"]),
             "value"
@@ -366,56 +537,84 @@ def build_app(instrument_name, start_folder):
         
     # display
 
-    for key in ("vmin","vmax","gamma","contrast","stretch","cmap"):
+    for key in ("vmin","vmax","gamma","contrast","stretch","cmap","quantiles"):
         w[key].param.watch(update_image, "value")
 
     # transforms
 
-    w["flip_x"].param.watch(lambda e: (_state["transform"].__setitem__("flip_x", w["flip_x"].value), update_image()), "value")
-    w["flip_y"].param.watch(lambda e: (_state["transform"].__setitem__("flip_y", w["flip_y"].value), update_image()), "value")
-    w["neg"].param.watch(lambda e: (_state["transform"].__setitem__("negative", w["neg"].value), update_image()), "value")
+    w["flip_x"].param.watch(lambda e: (state.transform.__setitem__("flip_x", w["flip_x"].value), update_image()), "value")
+    w["flip_y"].param.watch(lambda e: (state.transform.__setitem__("flip_y", w["flip_y"].value), update_image()), "value")
+    w["neg"].param.watch(lambda e: (state.transform.__setitem__("negative", w["neg"].value), update_image()), "value")
     
     def on_rotate_click(event):
-        _state["transform"]["rot90"] = (_state["transform"]["rot90"] + 1) % 4
+        state.transform["rot90"] = (state.transform["rot90"] + 1) % 4
         update_image()
 
     w["rot90"].on_click(on_rotate_click)
 
     # Arithmetic
 
-    for key in ("arith_on", "arith_op", "arith_file"):
+    for key in ("arith_on", "arith_op", "arith_file", "arith_expr", "arith_names"):
         w[key].param.watch(update_image, "value")
 
-    # Cuts
+    # Stacking
 
-    w["cuts_on"].param.watch(update_image, "value")
-    w["cuts_on"].param.watch(lambda e: update_cut_overlay(), "value")
-    w["cuts_toggle"].param.watch(lambda e: update_cut_overlay(), "value")
+    w["stack_on"].param.watch(update_image, "value")
+    for key in ("stack_method", "stack_sigma", "stack_last", "stack_files"):
+        w[key].param.watch(lambda e: w["stack_on"].value and update_image(), "value")
+
+    # Cuts
 
-    for key in ("x1","y1","x2","y2"):
-        w[key].param.watch(lambda e: update_cut_overlay(), "value")
+    # the overlay is redrawn (or cleared) with the profile when the render is applied
+    for key in ("cuts_on", "cuts_toggle", "x1", "y1", "x2", "y2", "cut_width"):
         w[key].param.watch(update_image, "value")
 
     # Region 
 
-    w["region_on"].param.watch(update_image, "value")
-    w["region_on"].param.watch(lambda e: update_region_overlay(), "value")
-    w["region_toggle"].param.watch(lambda e: update_region_overlay(), "value")
-
-    for key in ("region_shape", "region_x", "region_y", "region_d"):
-        w[key].param.watch(lambda e: update_region_overlay(), "value")
-        w[key].param.watch(update_image, "value")
+    for key in ("region_on", "region_toggle", "region_shape", "region_x", "region_y", "region_d"):
+        w[key].param.watch(region_scheduler.request, "value")
         
+    # pan / zoom
+
+    image_fig.on_event(RangesUpdate, on_ranges)
+
     # Header
 
     w["hdr_ext"].param.watch(update_header, "value")
-    w["file_sel"].param.watch(lambda e: (update_extensions(), update_header()), "value")
-    w["hdr_search"].param.watch(apply_header_filter, "value")
+    w["hdr_search"].param.watch(apply_header_filter, "value_input")
+    w["hdr_page"].param.watch(show_page, "value")
     w["hdr_toggle"].param.watch(lambda e: update_header(), "value")
 
+    # Diagnostics
+
+    w["diag_toggle"].param.watch(update_diagnostics, "value")
+    w["diag_on"].param.watch(on_diag_record, "value")
+    w["diag_clear"].on_click(on_diag_clear)
+
+    # Session end
+
+    def on_session_destroyed(session_context):
+        """Release what this browser connection held in the shared workers."""
+        autofetch_stop_impl(state)
+        prefetcher.cancel()
+        apply_header_filter.cancel()
+        show_page.cancel()
+        scheduler.cancel()
+        region_scheduler.cancel()
+        _runner.forget(doc)
+
+    if doc is not None and doc.session_context is not None:
+        doc.on_session_destroyed(on_session_destroyed)
+
     # Initial load
     scan_folder()
 
     return layout
 
 
+def app_factory(instrument_name, start_folder, diagnostics=False):
+    """Function for pn.serve building a separate app per browser connection."""
+    # a plain function: pn.serve would display a functools.partial as an object
+    def app():
+        return build_app(instrument_name, start_folder, diagnostics=diagnostics)
+    return app
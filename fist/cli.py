@@ -2,20 +2,29 @@
 
 import sys
 import argparse
+from pathlib import Path
 import panel as pn
 
 from importlib.resources import files, as_file
 
-from fist.app import build_app
+from fist.app import app_factory
+from fist.core.cache import _slice_cache
+from fist.core.scratch import ScratchStore
+from fist.core.tracing import _tracer
 
 
 def main():
+    # headless subcommand: fist render ...
+    if len(sys.argv) > 1 and sys.argv[1] == "render":
+        return render_main(sys.argv[2:])
+
     parser = argparse.ArgumentParser(
         description="FITS Inspection Streamlined Tool",
         epilog=(
             "Examples:\n"
             "  fist --instrument ESPRESSO --folder example (to run the example)\n"
             "  fist --instrument KPF --folder /path/to/fits\n"
+            "  fist render --help (headless quick-look PNG/WebP rendering)\n"
         ),
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
@@ -28,11 +37,36 @@ def main():
                     help="Port for the Panel server (default: 5006)")
     parser.add_argument("--show", action="store_true", default=True,
                     help="Open the application in a browser at startup.")
+    parser.add_argument("--no-show", dest="show", action="store_false",
+                    help="Do not open a browser (e.g. on a remote server).")
+    parser.add_argument("--cache-mb", type=int, default=1024,
+                    help="Memory budget for decoded image slices in MB (default: 1024)")
+    parser.add_argument("--num-procs", type=int, default=1,
+                    help="Server worker processes sharing the port (default: 1, 0 = one per core; "
+                         "not available on Windows)")
+    parser.add_argument("--scratch-dir", type=str, default=None,
+                    help="Folder for decoded images shared between worker processes "
+                         "(default: a folder in the system temp dir, used when --num-procs > 1)")
+    parser.add_argument("--scratch-mb", type=int, default=4096,
+                    help="Disk budget of the shared decoded images in MB (default: 4096)")
+    parser.add_argument("--diagnostics", action="store_true",
+                    help="Record stage timings and show them in a diagnostics panel")
+    parser.add_argument("--websocket-compression-level", type=int, default=None,
+                    choices=range(0, 10), metavar="0-9",
+                    help="Deflate compression of browser updates (default: off; "
+                         "1 is a good choice for remote connections)")
 
     args = parser.parse_args()
 
     ins_name = args.instrument.upper()
 
+    _slice_cache.max_bytes = args.cache_mb * 1024**2
+    _tracer.enabled = args.diagnostics
+
+    # several processes: decode each frame once, in whichever serves it first
+    if args.num_procs != 1 or args.scratch_dir is not None:
+        _slice_cache.store = ScratchStore(args.scratch_dir, max_bytes=args.scratch_mb * 1024**2)
+
     # example folder definition
     if args.folder is not None:
         if args.folder.upper() == "EXAMPLE":
@@ -47,14 +81,17 @@ def main():
         f"    Instrument : {ins_name}\n"
         f"    Folder     : {args.folder}\n"
         f"    Port       : {args.port}\n"
+        f"    Processes  : {args.num_procs or 'one per core'}\n"
     )
 
     # ------------------------------------------------------------------
     # Build Panel application
     # ------------------------------------------------------------------
 
-    # Build Panel layout dynamically
-    app = build_app(instrument_name=ins_name, start_folder=args.folder)
+    # one app (widgets, state, pipeline) per browser connection; decoded
+    # slices, the file index and parsed headers are shared between them
+    app = app_factory(instrument_name=ins_name, start_folder=args.folder,
+                      diagnostics=args.diagnostics)
 
     # Start the Panel server
     pn.serve(
@@ -62,9 +99,74 @@ def main():
         show=args.show,
         autoreload=False,
         port=args.port,
-        title="FIST"
+        title="FIST",
+        websocket_compression_level=args.websocket_compression_level,
+        num_procs=args.num_procs,
+    )
+
+def render_main(argv=None):
+    from fist.core.instruments import load_instrument
+    from fist.core.scaling import QUANTILE_METHODS
+    from fist.tools.render import render_folder, render_settings, RENDER_FORMATS
+
+    parser = argparse.ArgumentParser(
+        prog="fist render",
+        description="Render a folder of FITS frames to quick-look images, "
+                    "as displayed by the viewer with the instrument defaults",
+        epilog=(
+            "Examples:\n"
+            "  fist render /path/to/fits --instrument KPF --filetype 2D --out quicklook\n"
+            "  fist render /path/to/fits --instrument ESPRESSO --filetype guiding --format webp\n"
+        ),
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("folder", help="Folder to read FITS files from")
+    parser.add_argument("--instrument", type=str, default="KPF",
+                        help="Instrument name (e.g. KPF)")
+    parser.add_argument("--filetype", type=str, default=None,
+                        help="File type to render (default: the instrument's default)")
+    parser.add_argument("--out", type=str, default=None,
+                        help="Output folder (default: <folder>/quicklook)")
+    parser.add_argument("--format", choices=RENDER_FORMATS, default="png")
+    parser.add_argument("--ext", type=str, default=None,
+                        help="FITS extension (default: first image extension)")
+    parser.add_argument("--plane", type=int, default=None,
+                        help="Plane of 3-D cubes (default: 0)")
+    parser.add_argument("--max-size", type=int, default=None,
+                        help="Halve images until the longest side fits (default: 1024, 0 = full size)")
+    parser.add_argument("--vmin", type=float, default=None, help="Lower percentile")
+    parser.add_argument("--vmax", type=float, default=None, help="Upper percentile")
+    parser.add_argument("--stretch", type=str, default=None)
+    parser.add_argument("--quantiles", choices=QUANTILE_METHODS, default=None)
+    parser.add_argument("--cmap", type=str, default=None)
+    parser.add_argument("--quality", type=int, default=None, help="WebP quality (default: 90)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes (default: one per core)")
+    parser.add_argument("--force", action="store_true",
+                        help="Render files whose output is already up to date")
+    args = parser.parse_args(argv)
+
+    instr = load_instrument(args.instrument.upper())
+    filetype = args.filetype or instr["default_filetype"]
+    out = args.out or str(Path(args.folder) / "quicklook")
+    settings = render_settings(
+        instr, ext=args.ext, plane=args.plane, max_size=args.max_size,
+        vmin=args.vmin, vmax=args.vmax, stretch=args.stretch,
+        quantiles=args.quantiles, cmap=args.cmap, quality=args.quality,
     )
 
+    res = render_folder(args.folder, out, instr, filetype, fmt=args.format,
+                        workers=args.workers, force=args.force, settings=settings)
+
+    print(
+        f"{res['rendered']} rendered, {res['skipped']} up to date, {res['failed']} failed "
+        f"({res['files']} {filetype} files) -> {out}\n"
+        f"{res['wall']:.2f} s on {res['workers']} workers: {res['fps']:.2f} frames/s, "
+        f"{res['fps_per_core']:.2f} frames/s per core"
+    )
+    return 1 if res["failed"] else 0
+
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
 
@@ -0,0 +1,148 @@
+# decoded image slice cache
+# Keeps recently decoded slices in memory so redraws do not reread the FITS file
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from fist.core.tracing import _tracer
+
+DEFAULT_CACHE_BYTES = 1024 * 1024**2   # 1 GiB
+
+
+def file_signature(fn):
+    """
+    Return (path, mtime_ns, size) identifying the current contents of a file.
+    Raises OSError if the file cannot be stat'ed.
+    """
+    st = os.stat(fn)
+    return (os.fspath(fn), st.st_mtime_ns, st.st_size)
+
+
+class SliceCache:
+    """
+    Byte-budgeted LRU cache of decoded image slices.
+
+    Keys are (path, mtime_ns, size, extname, src_idx). A file rewritten on
+    disk no longer matches its old keys; those entries are dropped as soon
+    as the new version is stored. Cached arrays are made read-only, callers
+    must copy before modifying them.
+
+    An optional `store` (see scratch.ScratchStore) is a second level shared
+    with other processes: misses look there before decoding, and decoded
+    slices are written to it.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, store=None):
+        self.max_bytes = max_bytes
+        self.store = store
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._inflight = {}     # key -> lock held while the slice is decoded
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        # a probe: neither the LRU order nor the counters change
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            arr = self._entries.get(key)
+            if arr is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return arr
+
+    def get_or_load(self, key, load):
+        """
+        Return the cached slice for `key`, calling load() on a miss.
+        Concurrent misses on the same key (e.g. a prefetch and a redraw)
+        decode the file only once; the other callers wait for the result.
+        Each lookup is traced as a "slice_cache" span, flagged as a hit when
+        served from memory; the decode itself has its own span.
+        """
+        t0 = time.perf_counter()
+        arr = self.get(key)
+        if arr is not None:
+            if _tracer.enabled:
+                _tracer.record("slice_cache", "cache", t0, time.perf_counter() - t0, hit=True)
+            return arr
+
+        with self._lock:
+            key_lock = self._inflight.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                with self._lock:
+                    arr = self._entries.get(key)
+                if arr is None:
+                    store = self.store
+                    arr = store.get(key) if store is not None else None
+                    if arr is None:
+                        arr = load()
+                        if arr is not None and store is not None:
+                            store.put(key, arr)
+                    if arr is not None:
+                        self.put(key, arr)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+        if _tracer.enabled:
+            _tracer.record("slice_cache", "cache", t0, time.perf_counter() - t0)
+        return arr
+
+    def put(self, key, arr):
+        size = arr.nbytes
+        if size > self.max_bytes:
+            return
+        arr.setflags(write=False)
+        with self._lock:
+            # entries for an older version of the same file are now stale
+            path, sig = key[0], key[1:3]
+            for k in [k for k in self._entries if k[0] == path and k[1:3] != sig]:
+                self._drop(k)
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = arr
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, path):
+        """Drop every cached slice of a given file."""
+        path = os.fspath(path)
+        with self._lock:
+            for k in [k for k in self._entries if k[0] == path]:
+                self._drop(k)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Return a snapshot of the cache counters."""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "nbytes": self.nbytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def _drop(self, key):
+        arr = self._entries.pop(key)
+        self.nbytes -= arr.nbytes
+
+
+# shared by all display, cuts, region and arithmetic reads
+_slice_cache = SliceCache()
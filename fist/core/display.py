@@ -1,22 +1,76 @@
 # image setup and display tools
 
+import functools
+
 import numpy as np
 from bokeh.plotting import figure
-from bokeh.models import DataRange1d, ColumnDataSource
+from bokeh.models import DataRange1d, ColumnDataSource, LinearColorMapper
 from bokeh.events import Reset
-import matplotlib.cm as cm
-
-def rgba_uint32_from_norm(arr01, cmap_name="viridis"):
-    cmap = cm.get_cmap(cmap_name)
-    rgba = cmap(arr01, bytes=True)  # (h,w,4)
-
-    r = rgba[...,0].astype(np.uint32)
-    g = rgba[...,1].astype(np.uint32)
-    b = rgba[...,2].astype(np.uint32)
-    a = rgba[...,3].astype(np.uint32)
-
-    # Bokeh expects: 0xAABBGGRR (little-endian)
-    return (a << 24) | (b << 16) | (g << 8) | r
+import matplotlib
+from fist.core.tracing import traced
+
+# number of colours in a colormap lookup table (256 or 4096)
+LUT_SIZES = (256, 4096)
+DEFAULT_LUT_SIZE = 256
+
+# how images travel to the browser: table indices + palette, or packed RGBA
+IMAGE_TRANSPORTS = ("indexed", "rgba")
+
+@functools.lru_cache(maxsize=64)
+def colormap_lut(cmap_name, size=DEFAULT_LUT_SIZE):
+    """
+    Packed uint32 RGBA lookup table of a matplotlib colormap, `size` entries.
+    Bokeh expects 0xAABBGGRR, i.e. the RGBA bytes read as a little-endian
+    uint32. Cached per (colormap, size); the table is read-only.
+    """
+    if size not in LUT_SIZES:
+        raise ValueError(f"Unknown LUT size {size}. Available: {LUT_SIZES}")
+    cmap = matplotlib.colormaps[cmap_name].resampled(size)
+    rgba = np.ascontiguousarray(cmap(np.arange(size), bytes=True))  # (size, 4) uint8
+    lut = rgba.view("<u4")[:, 0].copy()
+    lut.setflags(write=False)
+    return lut
+
+@functools.lru_cache(maxsize=64)
+def colormap_palette(cmap_name, size=DEFAULT_LUT_SIZE):
+    """The lookup table as a Bokeh palette of "#rrggbbaa" strings."""
+    rgba = colormap_lut(cmap_name, size).view(np.uint8).reshape(-1, 4)
+    return tuple("#%02x%02x%02x%02x" % tuple(c) for c in rgba)
+
+@traced("display")
+def quantize_norm(arr01, lut_size=DEFAULT_LUT_SIZE):
+    """
+    Quantize a [0, 1] image (NaN-free) into colormap table indices: uint8
+    for a 256-entry table, uint16 for 4096. Bins are those of matplotlib,
+    floor(x * N), with x == 1 in the last bin.
+    """
+    # one pass: the float -> integer cast happens inside the multiply, so
+    # no full-size float temporary is made. Scaling by the float32 just
+    # below N keeps x == 1 in range
+    idx = np.empty(np.shape(arr01), np.uint8 if lut_size <= 256 else np.uint16)
+    scale = np.nextafter(np.float32(lut_size), np.float32(0))
+    np.multiply(arr01, scale, out=idx, casting="unsafe")
+    return idx
+
+@traced("display")
+def colormap_indices(idx, cmap_name="viridis", out=None, lut_size=DEFAULT_LUT_SIZE):
+    """
+    Packed uint32 RGBA image from quantized indices (see quantize_norm).
+    Pass `out` (uint32, same shape) to reuse an output buffer.
+    """
+    lut = colormap_lut(cmap_name, lut_size)
+    if out is not None and out.shape != idx.shape:
+        out = None
+    return np.take(lut, idx, out=out, mode="clip")
+
+@traced("display")
+def rgba_uint32_from_norm(arr01, cmap_name="viridis", out=None, lut_size=DEFAULT_LUT_SIZE):
+    """
+    Colormap a [0, 1] image (NaN-free) into packed uint32 RGBA through the
+    colormap's lookup table. Pass `out` (uint32, same shape) to reuse an
+    output buffer instead of allocating one.
+    """
+    return colormap_indices(quantize_norm(arr01, lut_size), cmap_name, out=out, lut_size=lut_size)
 
 def make_image_figure():
     fig = figure(
@@ -33,44 +87,89 @@ def make_image_figure():
 
     return fig
 
-def set_image(fig, arr01, cmap):
-    arr01 = np.nan_to_num(arr01, nan=0.0)
-    arr01 = np.clip(arr01, 0, 1)
-
-    h, w = arr01.shape
-    rgba = rgba_uint32_from_norm(arr01, cmap)
-
-    # STEP 1: read previous image shape (stored on figure)
-    prev_shape = getattr(fig, "_image_shape", None)
-
-    # Find existing image renderer
-    renderer = None
+class RgbaBuffers:
+    """
+    Small pool of reusable uint32 image buffers for same-shape redraws.
+
+    A buffer is handed out again only if it is not listed in `busy` (e.g.
+    the image currently on the page): Bokeh detects changes by comparing
+    the new array against the old one, so a new image must always come in
+    a different array object.
+    """
+
+    def __init__(self, size=3):
+        self.size = size
+        self._bufs = []
+
+    def take(self, shape, busy=()):
+        shape = tuple(shape)
+        if self._bufs and self._bufs[0].shape != shape:
+            self._bufs = []
+        for buf in self._bufs:
+            if not any(buf is b for b in busy):
+                return buf
+        buf = np.empty(shape, np.uint32)
+        if len(self._bufs) < self.size:
+            self._bufs.append(buf)
+        return buf
+
+def _image_renderer(fig):
     for r in fig.renderers:
-        if hasattr(r, "glyph") and r.glyph.__class__.__name__ == "ImageRGBA":
-            renderer = r
-            break
-
-    # STEP 2: if shape changed, remove renderer
-    if renderer is not None and prev_shape != (h, w):
+        if hasattr(r, "glyph") and r.glyph.__class__.__name__ in ("Image", "ImageRGBA"):
+            return r
+    return None
+
+@traced("display")
+def show_image(fig, image, extent=None, shape=None, palette=None):
+    """
+    Show an image on the figure (document thread only).
+
+    `image` is packed uint32 RGBA, or with a `palette` (see colormap_palette)
+    the table indices from quantize_norm, which the browser colormaps: a
+    quarter of the bytes, and a colormap change only sends the palette.
+
+    `extent` = (x, y, dw, dh) places a cropped or downsampled view of an
+    image of full size `shape`; by default the image is shown whole. The
+    axes are reset to the full image only when `shape` changes, so zoom
+    and pan survive redraws. Returns True if they were reset.
+    """
+    h, w = image.shape if shape is None else shape
+    x, y, dw, dh = (0, 0, w, h) if extent is None else extent
+    glyph = "ImageRGBA" if palette is None else "Image"
+
+    renderer = _image_renderer(fig)
+    if renderer is not None and renderer.glyph.__class__.__name__ != glyph:
         fig.renderers.remove(renderer)
         renderer = None
 
-    # STEP 3: create or update renderer
+    # create once; afterwards only the changed columns and palette are sent
     if renderer is None:
-        fig.image_rgba(image=[rgba], x=0, y=0, dw=w, dh=h)
+        # placement as columns (not fixed values) so views can move
+        source = ColumnDataSource(data=dict(image=[image], x=[x], y=[y], dw=[dw], dh=[dh]))
+        cols = dict(image="image", x="x", y="y", dw="dw", dh="dh", source=source)
+        if palette is None:
+            fig.image_rgba(**cols)
+        else:
+            # index k maps to palette[k]
+            mapper = LinearColorMapper(palette=list(palette), low=0, high=len(palette))
+            fig.image(color_mapper=mapper, **cols)
     else:
-        renderer.data_source.data = dict(
-            image=[rgba], x=[0], y=[0], dw=[w], dh=[h]
-        )
-
-    # STEP 4: update ranges
-    fig.x_range.start = 0
-    fig.x_range.end   = w
-    fig.y_range.start = 0
-    fig.y_range.end   = h
-
-    # STEP 5: store shape for next call
+        source = renderer.data_source
+        if palette is not None:
+            renderer.glyph.color_mapper.palette = list(palette)
+        if image is not source.data["image"][0]:
+            if (source.data["x"], source.data["y"], source.data["dw"], source.data["dh"]) \
+                    == ([x], [y], [dw], [dh]):
+                # same placement: patch the image column only
+                source.data["image"] = [image]
+            else:
+                source.data = dict(image=[image], x=[x], y=[y], dw=[dw], dh=[dh])
+
+    # new image geometry: show all of it, and make Reset return here
+    if getattr(fig, "_image_shape", None) == (h, w):
+        return False
+    for rng, end in ((fig.x_range, w), (fig.y_range, h)):
+        rng.start, rng.end = 0, end
+        rng.reset_start, rng.reset_end = 0, end
     fig._image_shape = (h, w)
-
-
-
+    return True
@@ -0,0 +1,192 @@
+# header-only index of FITS files
+# Each file is opened once; sort keys and HDU layout are read from the headers
+# without touching pixel data, and every later lookup is served from memory
+
+import os
+import threading
+
+from astropy.io import fits
+
+from fist.core.cache import file_signature
+
+# FITS BITPIX -> numpy dtype of the stored pixels
+BITPIX_DTYPES = {8: "uint8", 16: "int16", 32: "int32", 64: "int64",
+                 -32: "float32", -64: "float64"}
+
+IMAGE_HDUS = (fits.PrimaryHDU, fits.ImageHDU, fits.CompImageHDU)
+
+
+def _header_value(hdr, key):
+    v = hdr.get(key)
+    # astropy marks keywords without value as Undefined
+    if v is None or isinstance(v, fits.card.Undefined):
+        return None
+    return v
+
+
+def _pixel_dtype(hdr):
+    bitpix = hdr.get("BITPIX")
+    dtype = BITPIX_DTYPES.get(bitpix)
+    # unsigned integers are stored as signed with BZERO = 2**(n-1)
+    if dtype and bitpix > 8 and hdr.get("BSCALE", 1) == 1 \
+            and hdr.get("BZERO", 0) == 2**(bitpix - 1):
+        dtype = "u" + dtype
+    elif hdr.get("BSCALE", 1) != 1 or hdr.get("BZERO", 0) != 0:
+        dtype = "float32" if bitpix in (8, 16, -32) else "float64"
+    return dtype
+
+
+def read_file_record(fn, keys=()):
+    """
+    Read primary-header values and HDU layout of a FITS file in one pass.
+
+    Returns a dict with path, mtime, size, the requested primary-header
+    `keys` and, per HDU, its index, name, whether it holds an image, NAXIS,
+    shape and pixel dtype.
+    """
+    path, mtime, size = file_signature(fn)
+    values = {}
+    hdus = []
+    with fits.open(path, memmap=True, lazy_load_hdus=True) as hdul:
+        # iterating only parses headers; data is never accessed
+        for i, hdu in enumerate(hdul):
+            hdr = hdu.header
+            if i == 0:
+                values = {k: _header_value(hdr, k) for k in keys}
+            image = isinstance(hdu, IMAGE_HDUS)
+            shape = tuple(hdu.shape) if image else ()
+            hdus.append(dict(
+                index=i,
+                name=hdu.name,
+                image=image,
+                naxis=len(shape) if image else hdr.get("NAXIS", 0),
+                shape=shape,
+                dtype=_pixel_dtype(hdr) if image else None,
+            ))
+    return dict(path=path, mtime=mtime, size=size, keys=values, hdus=hdus)
+
+
+class FileIndex:
+    """
+    Thread-safe in-memory index of FITS file records.
+
+    A record is (re)read when the file's mtime or size changed, or when a
+    primary-header key that was not indexed yet is requested.
+    """
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def record(self, fn, keys=()):
+        """Return the up-to-date record of a file, or None if it cannot be read."""
+        path = os.fspath(fn)
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.forget(path)
+            return None
+
+        with self._lock:
+            rec = self._records.get(path)
+        if rec is not None and (rec["mtime"], rec["size"]) == (st.st_mtime_ns, st.st_size):
+            missing = [k for k in keys if k not in rec["keys"]]
+            if not missing:
+                return rec
+            keys = list(rec["keys"]) + missing
+        else:
+            keys = list(keys) + [k for k in (rec["keys"] if rec else ()) if k not in keys]
+
+        try:
+            rec = read_file_record(path, keys)
+        except Exception:
+            self.forget(path)
+            return None
+
+        with self._lock:
+            self._records[path] = rec
+        return rec
+
+    def scan(self, files, keys=(), store=None):
+        """
+        Return {path: record} for all readable files.
+
+        Records missing from memory are first looked up in the persistent
+        `store` (an IndexStore) by path, mtime and size; only files absent
+        there are opened, and their new records are written back.
+        """
+        out = {}
+        pending = {}
+        for f in files:
+            path = os.fspath(f)
+            try:
+                st = os.stat(path)
+            except OSError:
+                self.forget(path)
+                continue
+            with self._lock:
+                rec = self._records.get(path)
+            if (rec is not None and (rec["mtime"], rec["size"]) == (st.st_mtime_ns, st.st_size)
+                    and all(k in rec["keys"] for k in keys)):
+                out[path] = rec
+            else:
+                pending[path] = (st.st_mtime_ns, st.st_size)
+
+        if store is not None and pending:
+            stored = store.load(pending, keys)
+            with self._lock:
+                self._records.update(stored)
+            out.update(stored)
+            pending = {p: sig for p, sig in pending.items() if p not in stored}
+
+        fresh = []
+        for path in pending:
+            rec = self.record(path, keys)
+            if rec is not None:
+                out[path] = rec
+                fresh.append(rec)
+
+        if store is not None and fresh:
+            store.save(fresh)
+        return out
+
+    def forget(self, fn):
+        with self._lock:
+            self._records.pop(os.fspath(fn), None)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    # -------------------------------
+    # Lookups
+    # -------------------------------
+
+    def image_extensions(self, fn):
+        """Names of extensions holding 2D or 3D images (unnamed -> PRIMARY)."""
+        rec = self.record(fn)
+        if rec is None:
+            return []
+        return [h["name"] or "PRIMARY" for h in rec["hdus"]
+                if h["image"] and h["naxis"] in (2, 3)]
+
+    def header_extensions(self, fn):
+        """Names of all HDUs, as listed in the header viewer (unnamed -> EXTi)."""
+        rec = self.record(fn)
+        if rec is None:
+            return []
+        return [h["name"] or f"EXT{h['index']}" for h in rec["hdus"]]
+
+    def hdu_info(self, fn, extname):
+        """Return the indexed layout of the first HDU called `extname`, or None."""
+        rec = self.record(fn)
+        if rec is None:
+            return None
+        return next((h for h in rec["hdus"] if h["name"] == extname), None)
+
+
+# shared by folder scans, autofetch, extension and sourcelet lookups
+_file_index = FileIndex()
@@ -0,0 +1,137 @@
+# persistent on-disk store for the header index
+# One SQLite database per data folder, kept in the user cache directory, so a
+# restarted viewer does not reopen files that have not changed
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+SCHEMA_VERSION = 1
+
+# paths per query (SQLite allows at most 999 parameters in older versions)
+LOAD_BATCH = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path  TEXT PRIMARY KEY,
+    mtime INTEGER NOT NULL,
+    size  INTEGER NOT NULL,
+    hdus  TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cards (
+    path  TEXT NOT NULL,
+    key   TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (path, key)
+);
+"""
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "fist"
+
+
+class IndexStore:
+    """
+    SQLite-backed store of header index records keyed by path, mtime and size.
+
+    `files` holds the HDU layout of each file; `cards` holds the indexed
+    primary-header values (JSON encoded, NULL when the key is absent).
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            if self._conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                self._conn.executescript("DROP TABLE IF EXISTS files; DROP TABLE IF EXISTS cards;")
+                self._conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            self._conn.executescript(SCHEMA)
+
+    def load(self, sigs, keys=()):
+        """
+        Return {path: record} for the entries of `sigs` ({path: (mtime, size)})
+        that are stored with the same signature and all requested `keys`.
+        Only the rows of those paths are read, and only the requested cards.
+        """
+        keys = tuple(dict.fromkeys(keys))
+        paths = list(sigs)
+        out = {}
+        for i in range(0, len(paths), LOAD_BATCH):
+            batch = paths[i:i + LOAD_BATCH]
+            marks = ",".join("?" * len(batch))
+            with self._lock:
+                rows = self._conn.execute(
+                    f"SELECT path, mtime, size, hdus FROM files WHERE path IN ({marks})", batch
+                ).fetchall()
+                rows = [r for r in rows if sigs[r[0]] == (r[1], r[2])]
+                card_rows = []
+                if rows and keys:
+                    card_rows = self._conn.execute(
+                        f"SELECT path, key, value FROM cards WHERE path IN ({','.join('?' * len(rows))})"
+                        f" AND key IN ({','.join('?' * len(keys))})",
+                        [r[0] for r in rows] + list(keys),
+                    ).fetchall()
+
+            cards = {}
+            for path, key, value in card_rows:
+                cards.setdefault(path, {})[key] = None if value is None else json.loads(value)
+
+            for path, mtime, size, hdus in rows:
+                values = cards.get(path, {})
+                if len(values) != len(keys):
+                    continue
+                hdus = json.loads(hdus)
+                for h in hdus:
+                    h["shape"] = tuple(h["shape"])
+                out[path] = dict(path=path, mtime=mtime, size=size, keys=values, hdus=hdus)
+        return out
+
+    def save(self, records):
+        """Insert or replace the given records."""
+        records = list(records)
+        if not records:
+            return
+        files = [(r["path"], r["mtime"], r["size"], json.dumps(r["hdus"])) for r in records]
+        cards = [
+            (r["path"], k, None if v is None else json.dumps(v, default=str))
+            for r in records for k, v in r["keys"].items()
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", files)
+            self._conn.executemany("DELETE FROM cards WHERE path = ?", [(f[0],) for f in files])
+            self._conn.executemany("INSERT INTO cards VALUES (?, ?, ?)", cards)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def store_for_folder(folder, cache_dir=None):
+    """
+    Return the (shared) IndexStore for a data folder, or None if no database
+    can be created. Data folders themselves are never written to.
+    """
+    folder = Path(folder).expanduser().resolve()
+    with _stores_lock:
+        if folder in _stores:
+            return _stores[folder]
+        digest = hashlib.sha1(str(folder).encode()).hexdigest()[:16]
+        db_path = Path(cache_dir or default_cache_dir()) / f"index-{digest}.sqlite"
+        try:
+            store = IndexStore(db_path)
+        except (OSError, sqlite3.Error):
+            store = None
+        _stores[folder] = store
+        return store
@@ -20,6 +20,9 @@ DEFAULT_CONFIG = dict(
     
     # Key for sorting files
     sort_key = "MJD-OBS",
+
+    # keep the folder header index on disk (user cache dir) between sessions
+    persistent_index = True,
     
     # display values
     default_scaling = {
@@ -28,6 +31,8 @@ DEFAULT_CONFIG = dict(
         "gamma": 1.0,
         "contrast": 1.0,
         "stretch": "linear",
+        # percentile estimator: "sampled" (fast) or "exact"
+        "quantiles": "sampled",
     },
     
     # transform starting state
@@ -41,6 +46,28 @@ DEFAULT_CONFIG = dict(
     # colormap
     default_cmap = "viridis",
 
+    # colours in the colormap lookup table (256 or 4096)
+    lut_size = 256,
+
+    # image sent to the browser: "indexed" (1-2 bytes per pixel, colormapped
+    # in the browser) or "rgba" (4 bytes per pixel)
+    image_transport = "indexed",
+
+    # files decoded ahead of the index slider (0 disables prefetching)
+    prefetch_depth = 2,
+
+    # floating-point precision of the display pipeline ("float32" or "float64")
+    working_dtype = "float32",
+
+    # images larger than this (MB, as float64) get "exact" quantile scaling
+    # from a streamed histogram instead of a sorted copy; region statistics
+    # are streamed when the regions' bounding boxes alone would exceed it
+    stream_stats_mb = 256,
+
+    # pixels of the quick preview shown while a new frame is decoded
+    # (0 disables the preview)
+    preview_pixels = 512 * 512,
+
 )
 
 # -------------------------
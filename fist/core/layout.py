@@ -55,10 +55,17 @@ def build_widgets(instr):
                                        options=["viridis","gray","plasma","magma",
                                                 "inferno","cividis","hot"],
                                        value=instr["default_cmap"], width=275)
+    w["quantiles"] = pn.widgets.Select(name="Quantiles",
+                                       options=["sampled","exact"],
+                                       value=scale.get("quantiles", "sampled"), width=275)
+    # renders run versus requested by widget changes (see RenderScheduler)
+    w["render_info"] = pn.pane.Markdown("", width=265)
+
     w["disp_section"] = pn.Column(
         pn.Row(pn.Spacer(width=20), w["vmin"], w["vmax"]),
         pn.Row(pn.Spacer(width=20), w["gamma"], w["contrast"]),
         pn.Row(pn.Spacer(width=20), w["stretch"], w["cmap"]),
+        pn.Row(pn.Spacer(width=20), w["quantiles"], pn.Spacer(width=10), w["render_info"]),
         visible=False       
     )
 
@@ -85,9 +92,26 @@ def build_widgets(instr):
     w["arith_on"] = pn.widgets.Toggle(name="Compute", value=False)
     w["arith_op"] = pn.widgets.Select(name="Op", options=["-","+","/","x"], width=50)
     w["arith_file"] = pn.widgets.Select(name="Second file", options=["None"], width=385)
+    # expression over A (displayed image), B (second file) and named images
+    w["arith_expr"] = pn.widgets.TextInput(name="Expression (empty: A op B)",
+                                           placeholder="(A - B) / C * 1.2", width=250)
+    w["arith_names"] = pn.widgets.TextInput(name="Names",
+                                            placeholder="C = flat.fits, D = [RED_CCD]", width=285)
     
+    # stacking: replaces the displayed frame, before the operation above
+    w["stack_on"] = pn.widgets.Toggle(name="Stack", value=False)
+    w["stack_method"] = pn.widgets.Select(name="Method", options=["mean", "median", "sigclip"],
+                                          value="median", width=90)
+    w["stack_sigma"] = pn.widgets.FloatInput(name="sigma", width=60, value=3.0, start=0.5)
+    # 0 = stack the files selected below instead of the last N
+    w["stack_last"] = pn.widgets.IntInput(name="Last N (0: selection)", width=150, value=5, start=0)
+    w["stack_files"] = pn.widgets.MultiChoice(name="Frames", options={}, width=540)
+
     w["arith_section"] = pn.Column(
         pn.Row(pn.Spacer(width=20), w["arith_on"], pn.Spacer(width=7), w["arith_op"], pn.Spacer(width=7), w["arith_file"]),
+        pn.Row(pn.Spacer(width=20), w["arith_expr"], w["arith_names"]),
+        pn.Row(pn.Spacer(width=20), w["stack_on"], pn.Spacer(width=7), w["stack_method"], w["stack_sigma"], w["stack_last"]),
+        pn.Row(pn.Spacer(width=20), w["stack_files"]),
         visible=False  
     )
 
@@ -101,6 +125,8 @@ def build_widgets(instr):
     w["y1"] = pn.widgets.FloatInput(name="y1", width=80, value=0)
     w["x2"] = pn.widgets.FloatInput(name="x2", width=80, value=10)
     w["y2"] = pn.widgets.FloatInput(name="y2", width=80, value=10)
+    # pixels averaged across the cut
+    w["cut_width"] = pn.widgets.IntInput(name="width", width=60, value=1, start=1, end=101)
     
     fig, src = make_cut_figure()
     w["cut_fig"] = fig
@@ -112,7 +138,7 @@ def build_widgets(instr):
     w["cut_points_src"] = ColumnDataSource(data=dict(x=[], y=[]))
 
     w["cuts_section"] = pn.Column(
-        pn.Row(pn.Spacer(width=45), w["cuts_on"], pn.Spacer(width=25), w["x1"], w["y1"], w["x2"], w["y2"]),
+        pn.Row(pn.Spacer(width=45), w["cuts_on"], pn.Spacer(width=25), w["x1"], w["y1"], w["x2"], w["y2"], w["cut_width"]),
         pn.Row(pn.Spacer(width=20), w["cut_panel"]),
         visible=False  
     )
@@ -143,19 +169,44 @@ def build_widgets(instr):
         button_type="success", width=80)
     
     w["hdr_ext"] = pn.widgets.Select(name="Header Extension", options=["PRIMARY"], value="PRIMARY", width=160)
-    w["hdr_search"] = pn.widgets.TextInput(name="Search", placeholder="Type to filter header...", width=300)
-    w["hdr_full_text"] = ""     # stores full header text (unfiltered)
+    w["hdr_search"] = pn.widgets.TextInput(name="Search", placeholder="Filter header (key:, value:, comment:)", width=300)
+    w["hdr_page"] = pn.widgets.IntInput(name="Page", value=1, start=1, end=1, width=70)
+    w["hdr_info"] = pn.pane.Markdown("", width=250)
     w["hdr_pane"] = pn.pane.HTML("<pre></pre>", width=700, height=300)
+    # parsed header on show (HeaderCards), current query and matching lines
+    w["hdr_cards"] = None
+    w["hdr_query"] = None
+    w["hdr_matches"] = []
     
     w["hdr_section"] = pn.Column(
         pn.Row(pn.Spacer(width=20), w["hdr_ext"], pn.Spacer(width=20), w["hdr_search"]),
+        pn.Row(pn.Spacer(width=20), w["hdr_page"], pn.Spacer(width=10), w["hdr_info"]),
         pn.Row(pn.Spacer(width=10), w["hdr_pane"]),
         visible=False  
     )
 
+    # diagnostics (only laid out with --diagnostics)
+
+    w["diag_toggle"] = pn.widgets.Toggle(name="Show", value=False,
+        button_type="success", width=80)
+
+    w["diag_on"] = pn.widgets.Checkbox(name="Record timings (server-wide)", value=False, width=220)
+    w["diag_clear"] = pn.widgets.Button(name="Clear", width=80)
+    w["diag_json"] = pn.widgets.FileDownload(label="JSON", filename="fist-trace.json",
+                                             button_type="default", width=90)
+    w["diag_chrome"] = pn.widgets.FileDownload(label="Chrome trace", filename="fist-trace.chrome.json",
+                                               button_type="default", width=130)
+    w["diag_table"] = pn.pane.Markdown("", width=600)
+
+    w["diag_section"] = pn.Column(
+        pn.Row(pn.Spacer(width=20), w["diag_on"], w["diag_clear"], w["diag_json"], w["diag_chrome"]),
+        pn.Row(pn.Spacer(width=20), w["diag_table"]),
+        visible=False
+    )
+
     return w
     
-def assemble_layout(widgets, image_pane, instr):
+def assemble_layout(widgets, image_pane, instr, diagnostics=False):
 
     logo_path = files("fist.static") / "FISTlogo.png"
     logo_pane = pn.pane.PNG(str(logo_path), width=85) 
@@ -192,6 +243,13 @@ def assemble_layout(widgets, image_pane, instr):
         height_policy="auto",
     )
 
+    if diagnostics:
+        left.extend([
+            pn.Row(pn.Spacer(width=10), pn.pane.Markdown("---", width=590, height=10)),
+            pn.Row(pn.Spacer(width=40), pn.pane.Markdown("### Diagnostics"), pn.Spacer(width=10), widgets["diag_toggle"]),
+            widgets["diag_section"],
+        ])
+
     right = pn.Column(
         image_pane,
         sizing_mode="stretch_both",
@@ -6,6 +6,13 @@ from pathlib import Path
 import numpy as np
 from astropy.io import fits
 
+from fist.core.cache import _slice_cache, file_signature
+from fist.core.index import _file_index
+from fist.core.tracing import traced
+
+# pixel read strategies understood by read_image_slice
+READ_MODES = ("memmap", "full")
+
 def find_instrument_files(folder, filetype, instrument):
     """
     Return a sorted list of files matching the instrument-defined patterns
@@ -33,57 +40,177 @@ def find_instrument_files(folder, filetype, instrument):
     return sorted(files)
 
 
-def safe_get_header_value(fn, key):
+def scan_image_extensions(fn):
+    """
+    Return names of FITS extensions containing 2D or 3D image data.
+    """
+    return _file_index.image_extensions(fn)
+
+def load_image_slice(fn, extname, src_idx, cache=_slice_cache, mode="memmap",
+                     dtype=np.float32):
+    """
+    Load a 2D image from a FITS extension.
+    For 3D data cubes, returns the selected slice index.
+
+    Decoded slices are served from `cache` while the file is unchanged on disk.
+    `mode` selects how the pixels are read (see `read_image_slice`) and
+    `dtype` the floating-point working precision of the returned slice.
+    """
+    dtype = np.dtype(dtype)
     try:
-        hdr = fits.getheader(fn, 0, memmap=False)
-        return hdr.get(key)
-    except Exception:
+        key = file_signature(fn) + (extname, src_idx, dtype.str)
+    except OSError:
         return None
 
-def scan_image_extensions(fn):
+    return cache.get_or_load(
+        key, lambda: read_image_slice(fn, extname, src_idx, mode=mode, dtype=dtype)
+    )
+
+@traced("loader")
+def read_image_slice(fn, extname, src_idx, mode="memmap", dtype=np.float32):
     """
-    Return names of FITS extensions containing 2D or 3D image data.
+    Read one 2D plane of a FITS extension from disk, bypassing the cache.
+
+    mode="memmap" maps uncompressed HDUs and decodes only the requested plane,
+    applying BZERO/BSCALE/BLANK to that plane alone; tile-compressed HDUs are
+    read through their section interface, which decompresses only the tiles
+    that overlap the plane. mode="full" decodes the whole HDU before slicing.
+    The plane is returned as `dtype`.
     """
-    extnames=[]
+    if mode not in READ_MODES:
+        raise ValueError(f"Unknown read mode '{mode}'. Available: {READ_MODES}")
+
     try:
-        with fits.open(fn, memmap=False) as hdul:
-            for hdu in hdul:
-                data = hdu.data
-                if isinstance(data, np.ndarray) and data.ndim in (2, 3):
-                    # ext named as PRIMARY if not named
-                    name = hdu.name if hdu.name else "PRIMARY"
-                    extnames.append(name)
+        if mode == "full":
+            return _read_full(fn, extname, src_idx, dtype)
+        return _read_plane(fn, extname, src_idx, dtype)
     except Exception:
-        pass
-    return extnames
+        return None
 
-def load_image_slice(fn, extname, src_idx):
+def _find_hdu(hdul, extname):
+    for h in hdul:
+        if h.name == extname:
+            return h
+    return None
+
+def _plane_index(ndim, nplanes, src_idx):
+    """Return the plane to read for a 2D (None) or 3D image, or False if invalid."""
+    if ndim == 2:
+        return None
+    if ndim == 3:
+        if src_idx is None:
+            src_idx = 0
+        if 0 <= src_idx < nplanes:
+            return src_idx
+    return False
+
+def _read_plane(fn, extname, src_idx, dtype):
+    with fits.open(fn, memmap=True, do_not_scale_image_data=True) as hdul:
+        hdu = _find_hdu(hdul, extname)
+        if hdu is None:
+            return None
+
+        shape = hdu.shape
+        idx = _plane_index(len(shape), shape[0] if shape else 0, src_idx)
+        if idx is False:
+            return None
+
+        # compressed: decompress only the tiles covering the plane; the
+        # section holds stored values, scaled below like the memory map
+        if isinstance(hdu, fits.CompImageHDU):
+            raw = hdu.section[idx] if idx is not None else hdu.section[:, :]
+        else:
+            raw = hdu.data if idx is None else hdu.data[idx]
+        return _scale_raw(raw, hdu.header, dtype)
+
+def _scale_raw(raw, hdr, dtype):
+    """Copy of raw (unscaled) pixels as `dtype`, with BLANK/BSCALE/BZERO applied."""
+    arr = np.array(raw, dtype=dtype)
+    blank = hdr.get("BLANK")
+    if blank is not None and raw.dtype.kind in "iu":
+        arr[raw == blank] = np.nan
+    bscale = hdr.get("BSCALE", 1)
+    bzero = hdr.get("BZERO", 0)
+    if bscale != 1:
+        arr *= bscale
+    if bzero != 0:
+        arr += bzero
+    return arr
+
+def iter_plane_rows(fn, extname, src_idx, rows=256, dtype=np.float64, start=0, stop=None):
     """
-    Load a 2D image from a FITS extension.
-    For 3D data cubes, returns the selected slice index.
+    Yield (row0, block) row blocks of one image plane, straight from disk.
+
+    Only `rows` rows are decoded at a time (through the memory map, or the
+    tiles covering them for compressed HDUs), so planes larger than memory
+    can be streamed. `start`/`stop` restrict the rows read. Yields nothing
+    if the plane cannot be read.
+    """
+    with fits.open(fn, memmap=True, do_not_scale_image_data=True) as hdul:
+        hdu = _find_hdu(hdul, extname)
+        if hdu is None:
+            return
+        shape = hdu.shape
+        idx = _plane_index(len(shape), shape[0] if shape else 0, src_idx)
+        if idx is False:
+            return
+        nrows = shape[-2] if stop is None else min(stop, shape[-2])
+        compressed = isinstance(hdu, fits.CompImageHDU)
+        plane = None if compressed else (hdu.data if idx is None else hdu.data[idx])
+
+        for r0 in range(start, nrows, rows):
+            r1 = min(r0 + rows, nrows)
+            if compressed:
+                sec = hdu.section[idx, r0:r1] if idx is not None else hdu.section[r0:r1, :]
+            else:
+                sec = plane[r0:r1]
+            yield r0, _scale_raw(sec, hdu.header, dtype)
+
+@traced("loader")
+def read_image_preview(fn, extname, src_idx, max_pixels, dtype=np.float32):
+    """
+    Read every k-th row and column of one image plane, with k the smallest
+    step giving at most `max_pixels` pixels. For uncompressed HDUs only
+    those rows are touched through the memory map, so the cost follows the
+    preview size, not the file size; compressed HDUs still decompress the
+    tiles holding them.
+
+    Returns (preview, full_shape) or None if the plane cannot be read.
     """
     try:
-        from astropy.io import fits
-        with fits.open(fn, memmap=False) as hdul:
-            hdu = None
-            for h in hdul:
-                if h.name == extname:
-                    hdu = h
-                    break
-            if h is None:
+        with fits.open(fn, memmap=True, do_not_scale_image_data=True) as hdul:
+            hdu = _find_hdu(hdul, extname)
+            if hdu is None:
+                return None
+            shape = hdu.shape
+            idx = _plane_index(len(shape), shape[0] if shape else 0, src_idx)
+            if idx is False:
                 return None
-            arr = np.asarray(hdu.data, dtype=float)
-
-            # 2D image
-            if arr.ndim == 2:
-                return arr
-
-            # 3D cube: return selected slice
-            if arr.ndim == 3:
-                if src_idx is None:
-                    src_idx = 0
-                if 0 <= src_idx < arr.shape[0]:
-                    return arr[src_idx,:,:]
+            h, w = shape[-2:]
+            step = max(1, int(np.ceil(np.sqrt(h * w / max(1, max_pixels)))))
+
+            if isinstance(hdu, fits.CompImageHDU):
+                if idx is not None:
+                    sec = hdu.section[idx, ::step, ::step]
+                else:
+                    sec = hdu.section[::step, ::step]
+            else:
+                plane = hdu.data if idx is None else hdu.data[idx]
+                sec = plane[::step, ::step]
+            return _scale_raw(sec, hdu.header, dtype), (h, w)
     except Exception:
         return None
 
+def _read_full(fn, extname, src_idx, dtype):
+    with fits.open(fn, memmap=False) as hdul:
+        hdu = _find_hdu(hdul, extname)
+        if hdu is None:
+            return None
+        arr = np.asarray(hdu.data, dtype=dtype)
+
+        idx = _plane_index(arr.ndim, arr.shape[0], src_idx)
+        if idx is False:
+            return None
+        if idx is None:
+            return arr
+        return arr[idx,:,:].copy()
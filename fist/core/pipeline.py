@@ -0,0 +1,274 @@
+# staged render pipeline
+# load (or stack) -> arithmetic -> quantiles -> scaling -> transform -> pyramid
+# -> quantize (visible window) -> colormap (+ cut profile);
+# each stage remembers its last inputs and output, so a change only reruns
+# the stages downstream of it. A frame not decoded yet can first be shown as
+# a strided preview (RenderPipeline.preview)
+
+import threading
+import time
+
+import numpy as np
+
+from fist.core.cache import _slice_cache, file_signature
+from fist.core.loader import load_image_slice, read_image_preview
+from fist.core.scaling import percentile_clip, image_quantiles
+from fist.core.transforms import apply_transform
+from fist.core.streamstats import DEFAULT_STREAM_BYTES
+from fist.core.tracing import _tracer, result_nbytes
+from fist.core.pyramid import ImagePyramid, view_window, window_extent
+from fist.core.display import (
+    quantize_norm, colormap_indices, colormap_palette, RgbaBuffers, DEFAULT_LUT_SIZE
+)
+from fist.tools.arithmetic import compile_expression
+from fist.tools.stacking import load_stack, stack_key
+from fist.tools.analysis import compute_cut_profile
+
+STAGES = ("load", "arith", "stats", "scale", "transform", "pyramid", "quantize", "rgba", "cut")
+
+
+class RenderPipeline:
+    """
+    Per-session render pipeline with one memoized output per stage.
+
+    Stage keys are built from that stage's own parameters plus the key of
+    its input stage, and files enter the keys through their (path, mtime,
+    size) signature, so a rewritten file invalidates everything downstream.
+    Stage outputs are shared between runs and must not be modified in place.
+
+    With reuse_buffers=True, RGBA images (transport="rgba") of an unchanged
+    shape are written into recycled buffers; call `mark_shown` with the
+    image put on the page so its buffer is left alone until it is replaced.
+    """
+
+    def __init__(self, reuse_buffers=True):
+        self._memo = {}
+        self._buffers = RgbaBuffers() if reuse_buffers else None
+        self._shown = None
+        self._lock = threading.Lock()
+        self.runs = dict.fromkeys(STAGES, 0)
+        self.hits = dict.fromkeys(STAGES, 0)
+
+    def clear(self):
+        with self._lock:
+            self._memo.clear()
+
+    def mark_shown(self, image):
+        """Record the image currently displayed (document thread)."""
+        self._shown = image
+
+    def _rgba_out(self, shape):
+        if self._buffers is None:
+            return None
+        memo = self._memo.get("rgba")
+        busy = (self._shown,) if memo is None else (self._shown, memo[1])
+        return self._buffers.take(shape, busy=busy)
+
+    def preview(self, p, max_pixels):
+        """
+        Quick look at a frame that is not decoded yet: every k-th pixel of
+        it, about `max_pixels` of them, scaled with the percentiles of that
+        subsample and shown over the full image extent. Returns None when
+        the full render will be quick anyway (frame already decoded, or not
+        larger than the preview) and for stacks and arithmetic, which have
+        no cheap approximation. Runs alongside `run`, without its lock.
+        """
+        if not max_pixels or p.get("stack") is not None or p["arith"] is not None:
+            return None
+        with _tracer.span("preview", "pipeline"):
+            return self._preview(p, max_pixels)
+
+    def _preview(self, p, max_pixels):
+        dtype = np.dtype(p["dtype"])
+        try:
+            sig = file_signature(p["fname"])
+        except OSError:
+            return None
+        load_key = (sig, p["ename"], p["src_idx"], dtype.str)
+        memo = self._memo.get("load")
+        if (memo is not None and memo[0] == load_key) or sig + load_key[1:] in _slice_cache:
+            return None
+
+        out = read_image_preview(p["fname"], p["ename"], p["src_idx"], max_pixels, dtype=dtype)
+        if out is None or out[0].shape == out[1]:
+            return None
+        small, (h, w) = out
+
+        quantiles = image_quantiles(small, "sampled")
+        arr_s = percentile_clip(small, p["vmin"], p["vmax"], p["gamma"], stretch=p["stretch"],
+                                contrast=p["contrast"], dtype=dtype, quantiles=quantiles)
+        np.nan_to_num(arr_s, copy=False, nan=0.0)
+        T = p["transform"]
+        lut_size = p.get("lut_size", DEFAULT_LUT_SIZE)
+        idx = quantize_norm(apply_transform(arr_s, T), lut_size)
+        if p.get("transport", "indexed") == "indexed":
+            image, palette = idx, colormap_palette(p["cmap"], lut_size)
+        else:
+            image, palette = colormap_indices(idx, p["cmap"], lut_size=lut_size), None
+
+        return dict(
+            fname=p["fname"], sig=sig, image=image, palette=palette,
+            shape=(w, h) if T.get("rot90", 0) % 2 else (h, w),
+        )
+
+    def _stage(self, name, key, compute):
+        memo = self._memo.get(name)
+        if memo is not None and memo[0] == key:
+            self.hits[name] += 1
+            if _tracer.enabled:
+                _tracer.record(name, "pipeline", time.perf_counter(), 0.0, hit=True)
+            return memo[1]
+        with _tracer.span(name, "pipeline") as span:
+            value = compute()
+            if span is not None:
+                span.nbytes = result_nbytes(value)
+        self.runs[name] += 1
+        if value is None:
+            self._memo.pop(name, None)
+        else:
+            self._memo[name] = (key, value)
+        return value
+
+    def run(self, p):
+        """
+        Render the parameters from `render_params`. Pure computation: safe
+        to run on a worker thread, never touches widgets or Bokeh models.
+        """
+        with self._lock, _tracer.span("render", "pipeline"):
+            before = dict(self.runs)
+            res = self._run(p)
+            res["recomputed"] = [s for s in STAGES if self.runs[s] != before[s]]
+            return res
+
+    def _run(self, p):
+        dtype = p["dtype"]
+
+        # ---- Load ----
+        try:
+            sig = file_signature(p["fname"])
+        except OSError:
+            return dict(error="Cannot load image.")
+        stack = p.get("stack")
+        if stack is None:
+            load_key = (sig, p["ename"], p["src_idx"], np.dtype(dtype).str)
+            load = lambda: load_image_slice(p["fname"], p["ename"], p["src_idx"], dtype=dtype)
+        else:
+            # a stack of frames replaces the file's own image
+            files, method, sigma = stack
+            try:
+                load_key = stack_key(files, p["ename"], p["src_idx"], method, sigma, dtype)
+            except OSError:
+                return dict(error="Stack error")
+            load = lambda: load_stack(files, p["ename"], p["src_idx"], method, sigma, dtype=dtype)
+        arr_base = self._stage("load", load_key, load)
+        if arr_base is None:
+            return dict(error="Cannot load image." if stack is None else "Stack error")
+
+        # ---- Arithmetic ----
+        # an expression over the displayed image "A" and images bound to
+        # other names; keyed by the inputs' signatures
+        arith_key = (load_key, None)
+        if p["arith"] is not None:
+            text, bindings = p["arith"]
+            try:
+                expr = compile_expression(text)
+                unbound = [n for n in expr.names if n != "A" and n not in bindings]
+                if unbound:
+                    raise ValueError(f"Unbound name(s): {', '.join(unbound)}")
+                inputs = tuple((n, file_signature(bindings[n][0]), bindings[n][1])
+                               for n in expr.names if n != "A")
+            except ValueError as e:
+                return dict(error=f"Arithmetic error: {e}")
+            except OSError:
+                return dict(error="Arithmetic error")
+            arith_key = (load_key, expr.text, inputs)
+
+            def arith():
+                images = {"A": arr_base}
+                for n, (fn, ext) in ((n, bindings[n]) for n in expr.names if n != "A"):
+                    images[n] = load_image_slice(fn, ext, p["src_idx"], dtype=dtype)
+                out, nan_warn = expr.evaluate(images, dtype=dtype)
+                return None if out is None else (out, nan_warn)
+
+            out = self._stage("arith", arith_key, arith)
+            if out is None:
+                return dict(error="Arithmetic error")
+            arr, arith_nan_warning = out
+        else:
+            arr, arith_nan_warning = arr_base, False
+
+        # ---- Quantiles ----
+        # built once per image; slider moves then only look limits up
+        stream_bytes = p.get("stream_bytes", DEFAULT_STREAM_BYTES)
+        stats_key = (arith_key, p["quantiles"], stream_bytes)
+        quantiles = self._stage(
+            "stats", stats_key,
+            lambda: image_quantiles(arr, p["quantiles"], stream_bytes=stream_bytes),
+        )
+
+        # ---- Scaling ----
+        scale_key = (stats_key, p["vmin"], p["vmax"], p["gamma"], p["stretch"], p["contrast"])
+
+        def scale():
+            arr_s = percentile_clip(
+                arr,
+                p["vmin"], p["vmax"],
+                p["gamma"],
+                stretch=p["stretch"],
+                contrast=p["contrast"],
+                dtype=dtype,
+                quantiles=quantiles,
+            )
+            # arr_s is owned here: blank out NaNs once, for all later stages
+            return np.nan_to_num(arr_s, copy=False, nan=0.0)
+
+        arr_s = self._stage("scale", scale_key, scale)
+
+        # ---- Transform ----
+        T = p["transform"]
+        transform_key = (scale_key, tuple(sorted(T.items())))
+        arr_t = self._stage("transform", transform_key, lambda: apply_transform(arr_s, T))
+
+        # ---- Pyramid / view window ----
+        # only the visible part, at about screen resolution, is colormapped
+        pyramid = self._stage("pyramid", transform_key, lambda: ImagePyramid(arr_t))
+        window = view_window(pyramid.shape, pyramid.max_level, p.get("viewport"))
+        level, r0, r1, c0, c1 = window
+
+        # the compact table-index image is kept, so a colormap change is a
+        # single table lookup per pixel
+        lut_size = p.get("lut_size", DEFAULT_LUT_SIZE)
+        quantize_key = (transform_key, window, lut_size)
+        idx = self._stage(
+            "quantize", quantize_key,
+            lambda: quantize_norm(pyramid.level(level)[r0:r1, c0:c1], lut_size),
+        )
+
+        # ---- Colormap ----
+        # "indexed": the browser maps the indices through a palette, so a
+        # colormap change only sends the palette; "rgba": packed RGBA here
+        if p.get("transport", "indexed") == "indexed":
+            image, palette = idx, colormap_palette(p["cmap"], lut_size)
+        else:
+            palette = None
+            image = self._stage(
+                "rgba", (quantize_key, p["cmap"]),
+                lambda: colormap_indices(idx, p["cmap"], out=self._rgba_out(idx.shape),
+                                         lut_size=lut_size),
+            )
+
+        # ---- Cuts ----
+        cut = None
+        if p["cut"] is not None:
+            width = p.get("cut_width", 1)
+            cut = self._stage("cut", (arith_key, p["cut"], width),
+                              lambda: compute_cut_profile(arr, *p["cut"], width=width))
+
+        return dict(
+            fname=p["fname"], sig=sig, arr=arr, image=image, palette=palette, cut=cut,
+            nstack=0 if stack is None else len(stack[0]),
+            shape=pyramid.shape, level=level,
+            extent=window_extent(pyramid.shape, window),
+            arith_active=p["arith"] is not None,
+            arith_nan_warning=arith_nan_warning,
+        )
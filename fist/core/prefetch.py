@@ -0,0 +1,84 @@
+# predictive prefetch of neighbouring files into the slice cache
+# While the user steps through the file list, the next files in the
+# direction of travel are decoded in the background so each step is a
+# cache hit
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from fist.core.loader import load_image_slice
+
+DEFAULT_DEPTH = 2
+
+
+def prefetch_targets(n, idx, direction, depth):
+    """
+    Indices to warm around position `idx` of a list of `n` files, nearest
+    first. Moving forward (direction > 0) warms `depth` files ahead and one
+    behind, backwards the mirror image; without a direction both sides.
+    """
+    if direction > 0:
+        offsets = [k for k in range(1, depth + 1)] + [-1]
+    elif direction < 0:
+        offsets = [-k for k in range(1, depth + 1)] + [1]
+    else:
+        offsets = [o for k in range(1, depth + 1) for o in (k, -k)]
+    return [idx + o for o in offsets if 0 <= idx + o < n]
+
+
+# separate from the render pool so prefetching never delays a render request
+_prefetch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="fist-prefetch")
+
+
+class Prefetcher:
+    """
+    Per-session background loader that keeps the files around the current
+    index warm. Jobs that have not started when the index moves again are
+    cancelled.
+    """
+
+    def __init__(self, depth=DEFAULT_DEPTH, pool=_prefetch_pool):
+        self.depth = depth
+        self._pool = pool
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_idx = None
+        self._direction = 0
+
+    def _submit(self, fn, ename, src_idx, dtype):
+        fut = self._pool.submit(load_image_slice, fn, ename, src_idx, dtype=dtype)
+        self._pending.append(fut)
+
+    def _cancel_pending(self):
+        for fut in self._pending:
+            fut.cancel()
+        self._pending = [f for f in self._pending if not f.done()]
+
+    def on_index(self, files, idx, ename, src_idx, dtype):
+        """Called after the displayed file changed to position `idx` of `files`."""
+        if self.depth <= 0 or ename is None:
+            return
+        with self._lock:
+            if self._last_idx is not None and abs(idx - self._last_idx) <= self.depth:
+                # small steps: follow the scrolling direction
+                step = idx - self._last_idx
+                if step:
+                    self._direction = 1 if step > 0 else -1
+            else:
+                self._direction = 0
+            self._last_idx = idx
+
+            self._cancel_pending()
+            for i in prefetch_targets(len(files), idx, self._direction, self.depth):
+                self._submit(files[i], ename, src_idx, dtype)
+
+    def warm(self, fn, ename, src_idx, dtype):
+        """Decode one file in the background (e.g. a new autofetch arrival)."""
+        if ename is None:
+            return
+        with self._lock:
+            self._submit(fn, ename, src_idx, dtype)
+
+    def cancel(self):
+        with self._lock:
+            self._cancel_pending()
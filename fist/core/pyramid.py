@@ -0,0 +1,103 @@
+# multi-resolution image pyramid
+# Large frames are shown from a 2x2-averaged copy matched to the screen
+# resolution and cropped to the visible region, so what is sent to the
+# browser scales with the figure size instead of the detector size
+
+import math
+
+import numpy as np
+
+# view windows are rounded out to tiles of this many (level) pixels, so
+# small pans reuse the window already on the page
+TILE = 256
+
+# figure size assumed until the browser has reported the real one
+DEFAULT_VIEW_PIXELS = (1000, 800)
+
+
+def downsample2(arr):
+    """2x2 block mean of an image; an odd last row/column is averaged with itself."""
+    h, w = arr.shape
+    if h % 2 or w % 2:
+        arr = np.pad(arr, ((0, h % 2), (0, w % 2)), mode="edge")
+    out = arr[0::2, 0::2] + arr[1::2, 0::2]
+    out += arr[0::2, 1::2]
+    out += arr[1::2, 1::2]
+    out *= 0.25
+    return out
+
+
+class ImagePyramid:
+    """
+    Levels of an image, each half the size of the previous one. Level 0 is
+    the image itself; coarser levels are built on first use, down to one
+    that fits in a tile.
+    """
+
+    def __init__(self, base):
+        self.shape = base.shape
+        self.levels = [base]
+        longest = max(self.shape) if base.size else 1
+        self.max_level = max(0, math.ceil(math.log2(max(1, longest / TILE))))
+
+    def level(self, k):
+        k = min(k, self.max_level)
+        while len(self.levels) <= k:
+            self.levels.append(downsample2(self.levels[-1]))
+        return self.levels[k]
+
+
+def choose_level(span_x, span_y, px_w, px_h, max_level):
+    """Coarsest level that still has at least one image pixel per screen pixel."""
+    ratio = min(span_x / max(px_w, 1), span_y / max(px_h, 1))
+    if ratio < 2:
+        return 0
+    return min(int(math.log2(ratio)), max_level)
+
+
+def view_window(shape, max_level, viewport=None):
+    """
+    Level and tile-snapped window to render for a viewport.
+
+    `viewport` is (x0, x1, y0, y1, px_w, px_h): the visible data range and
+    the figure size in screen pixels, or None for the whole image. Returns
+    (level, r0, r1, c0, c1) with rows/columns in pixels of that level; the
+    window is the visible part of the image rounded out to whole tiles.
+    """
+    h, w = shape
+    if viewport is None:
+        x0, x1, y0, y1 = 0, w, 0, h
+        px_w, px_h = DEFAULT_VIEW_PIXELS
+    else:
+        x0, x1, y0, y1, px_w, px_h = viewport
+        x0, x1, y0, y1 = min(x0, x1), max(x0, x1), min(y0, y1), max(y0, y1)
+
+    # resolution from the view itself, so panning over an edge keeps the level
+    level = choose_level(x1 - x0, y1 - y0, px_w, px_h, max_level)
+
+    x0, x1, y0, y1 = max(0, x0), min(w, x1), max(0, y0), min(h, y1)
+    if x1 <= x0 or y1 <= y0:
+        # nothing of the image is visible: keep a coarse copy of all of it
+        x0, x1, y0, y1 = 0, w, 0, h
+        level = max_level
+
+    f = 2 ** level
+    lh, lw = -(-h // f), -(-w // f)
+
+    def snap(lo, hi, n):
+        lo = int(lo // f) // TILE * TILE
+        hi = -(-math.ceil(hi / f) // TILE) * TILE
+        return max(0, lo), min(n, hi)
+
+    r0, r1 = snap(y0, y1, lh)
+    c0, c1 = snap(x0, x1, lw)
+    return level, r0, r1, c0, c1
+
+
+def window_extent(shape, window):
+    """Data coordinates (x, y, dw, dh) covered by a view window."""
+    h, w = shape
+    level, r0, r1, c0, c1 = window
+    f = 2 ** level
+    x, y = c0 * f, r0 * f
+    return x, y, min(c1 * f, w) - x, min(r1 * f, h) - y
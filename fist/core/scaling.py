@@ -2,46 +2,191 @@
 
 import numpy as np
 
+from fist.core.streamstats import stream_stats, array_chunks, DEFAULT_STREAM_BYTES, ZSCALE_SAMPLES
+from fist.core.tracing import traced
 
-def percentile_clip(arr, pmin, pmax, gamma, stretch="linear", contrast=1.0):
-    a = np.array(arr, dtype=float)
-    if np.isnan(a).all():
-        return a
+# quantile estimators understood by image_quantiles
+QUANTILE_METHODS = ("sampled", "exact")
 
-    good = a[np.isfinite(a)]
-    if good.size == 0:
-        return a
+# pixels kept by the "sampled" estimator
+DEFAULT_QUANTILE_SAMPLES = 1_000_000
 
-    # Percentile-based normalization limits
-    lo = np.percentile(good, pmin)
-    hi = np.percentile(good, pmax)
+
+class Quantiles:
+    """
+    Sorted pixel values of an image (all finite pixels, or a regular
+    subsample of them), built once so any percentile is an O(1) lookup.
+    `samples` are pixels evenly spaced in image order, for zscale.
+    """
+
+    def __init__(self, sorted_values, exact, samples):
+        self.values = sorted_values
+        self.exact = exact
+        self.samples = samples
+        self._zscale = None
+
+    @property
+    def size(self):
+        return self.values.size
+
+    def percentile(self, q):
+        """Linearly interpolated percentile, as np.percentile's default."""
+        v = self.values
+        pos = np.clip(q, 0, 100) / 100.0 * (v.size - 1)
+        i = int(pos)
+        if i >= v.size - 1:
+            return float(v[-1])
+        return float(v[i] + (v[i + 1] - v[i]) * (pos - i))
+
+    def zscale(self):
+        """IRAF zscale limits from the sampled pixels."""
+        if self._zscale is None:
+            self._zscale = zscale_limits(self.samples)
+        return self._zscale
+
+
+@traced("scaling")
+def image_quantiles(arr, method="sampled", nsamples=DEFAULT_QUANTILE_SAMPLES,
+                    stream_bytes=DEFAULT_STREAM_BYTES):
+    """
+    Build the Quantiles of an image. "exact" sorts every finite pixel;
+    "sampled" sorts a strided subsample of about `nsamples` pixels, which
+    is exact for images smaller than that.
+
+    For "exact" on images larger than `stream_bytes` (as float64), nothing
+    is sorted: a streamed histogram (streamstats.HistogramQuantiles) gives
+    every percentile to within (max - min) / 65536.
+    """
+    if method not in QUANTILE_METHODS:
+        raise ValueError(f"Unknown quantile method '{method}'. Available: {QUANTILE_METHODS}")
+
+    flat = np.asarray(arr).ravel()
+    if method == "exact" and stream_bytes is not None and flat.size * 8 > stream_bytes:
+        return stream_stats(array_chunks(np.asarray(arr)), npixels=flat.size)[1]
+    # the same pixels stream_stats samples, so both give the same zscale
+    samples = np.array(flat[::max(1, flat.size // ZSCALE_SAMPLES)], dtype=np.float64)
+    exact = method == "exact" or flat.size <= nsamples
+    if not exact:
+        flat = flat[::flat.size // nsamples]
+    values = flat[np.isfinite(flat)]     # always a private copy
+    values.sort()
+    return Quantiles(values, exact, samples)
+
+
+def zscale_limits(samples, contrast=0.25, max_reject=0.5, min_npixels=5,
+                  krej=2.5, max_iterations=5):
+    """
+    IRAF zscale display limits.
+
+    Fits a line to the sorted sample with iterative sigma rejection and
+    returns (z1, z2) = median -/+ slope/contrast around the sample centre,
+    bounded by the sample range.
+    """
+    samples = np.sort(np.asarray(samples, dtype=float))
+    samples = samples[np.isfinite(samples)]
+    npix = samples.size
+    if npix == 0:
+        return 0.0, 1.0
+    zmin, zmax = samples[0], samples[-1]
+    if npix < min_npixels:
+        return float(zmin), float(zmax)
+
+    center = (npix - 1) // 2
+    median = np.median(samples)
+
+    minpix = max(min_npixels, int(npix * max_reject))
+    ngrow = max(1, int(npix * 0.01))
+    x = np.arange(npix)
+
+    badpix = np.zeros(npix, dtype=bool)
+    ngoodpix = npix
+    last_ngoodpix = npix + 1
+    slope = 0.0
+    for _ in range(max_iterations):
+        if ngoodpix >= last_ngoodpix or ngoodpix < minpix:
+            break
+        slope, intercept = np.polyfit(x[~badpix], samples[~badpix], 1)
+        flat = samples - (slope * x + intercept)
+        threshold = krej * flat[~badpix].std()
+        badpix |= (flat < -threshold) | (flat > threshold)
+        # grow rejected pixels by ngrow to reject their neighbours too
+        badpix = np.convolve(badpix, np.ones(ngrow), mode="same") > 0
+        last_ngoodpix = ngoodpix
+        ngoodpix = np.count_nonzero(~badpix)
+
+    if ngoodpix < minpix:
+        return float(zmin), float(zmax)
+
+    if contrast > 0:
+        slope = slope / contrast
+    z1 = max(zmin, median - (center - 1) * slope)
+    z2 = min(zmax, median + (npix - center) * slope)
+    return float(z1), float(z2)
+
+
+@traced("scaling")
+def percentile_clip(arr, pmin, pmax, gamma, stretch="linear", contrast=1.0,
+                    dtype=np.float32, quantiles=None, stream_bytes=DEFAULT_STREAM_BYTES):
+    """
+    Normalize an image to [0, 1] for display.
+
+    Limits are the pmin/pmax percentiles, or the IRAF zscale limits for
+    stretch="zscale". Pass `quantiles` (from image_quantiles) to look them
+    up instead of recomputing them from the pixels; without them, images
+    larger than `stream_bytes` get their limits from a streamed histogram
+    rather than a full copy of the finite pixels.
+
+    Works in `dtype` precision and returns a newly allocated array; every
+    step after the initial rescaling is done in place on that array.
+    """
+    a = np.asarray(arr)
+
+    if quantiles is None and stretch == "zscale":
+        quantiles = image_quantiles(a, "sampled")
+    elif quantiles is None and stream_bytes is not None and a.size * 8 > stream_bytes:
+        quantiles = image_quantiles(a, "exact", stream_bytes=stream_bytes)
+
+    if quantiles is not None:
+        if quantiles.size == 0:
+            return a.astype(dtype)
+        if stretch == "zscale":
+            lo, hi = quantiles.zscale()
+        else:
+            lo, hi = quantiles.percentile(pmin), quantiles.percentile(pmax)
+    else:
+        good = a[np.isfinite(a)]
+        if good.size == 0:
+            return a.astype(dtype)
+        # Percentile-based normalization limits (good is a private copy)
+        lo, hi = np.percentile(good, [pmin, pmax], overwrite_input=True)
+        del good
 
     # Linear rescaling to [0, 1]
-    scaled = (a - lo) / (hi - lo) if hi > lo else a - lo
-    scaled = np.clip(scaled, 0, 1)
+    scaled = np.subtract(a, lo, dtype=dtype)
+    if hi > lo:
+        scaled *= 1.0 / (hi - lo)
+    np.clip(scaled, 0, 1, out=scaled)
 
     # Optional non-linear stretch for display
     if stretch == "log":
-        scaled = np.log1p(9*scaled)/np.log1p(9)
+        scaled *= 9
+        np.log1p(scaled, out=scaled)
+        scaled *= 1.0 / np.log1p(9)
     elif stretch == "sqrt":
-        scaled = np.sqrt(scaled)
+        np.sqrt(scaled, out=scaled)
     elif stretch == "arcsinh":
-        scaled = np.arcsinh(5*scaled) / np.arcsinh(5)
-    elif stretch == "zscale":
-        # Approximate zscale stretch around median ± 1.5σ
-        med = np.nanmedian(scaled)
-        std = np.nanstd(scaled)
-        lo2 = med - 1.5*std
-        hi2 = med + 1.5*std
-        scaled = np.clip((scaled - lo2)/(hi2-lo2), 0, 1)
+        scaled *= 5
+        np.arcsinh(scaled, out=scaled)
+        scaled *= 1.0 / np.arcsinh(5)
 
     # Contrast adjustment around mid-gray
     if contrast != 1.0:
-        scaled = (scaled-0.5)*contrast + 0.5
-        scaled = np.clip(scaled, 0, 1)
+        scaled -= 0.5
+        scaled *= contrast
+        scaled += 0.5
+        np.clip(scaled, 0, 1, out=scaled)
 
     if gamma != 1.0:
-        scaled = scaled**(1.0/gamma)
+        np.power(scaled, 1.0/gamma, out=scaled)
 
     return scaled
-
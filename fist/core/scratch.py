@@ -0,0 +1,92 @@
+# shared decode store between server processes
+# Decoded slices are written once as .npy scratch files and memory-mapped by
+# every worker process, so a frame decoded by one worker is rendered by the
+# others without decoding it again, from pages shared through the OS cache
+
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_SCRATCH_BYTES = 4096 * 1024**2   # 4 GiB
+
+
+def default_scratch_dir():
+    return Path(tempfile.gettempdir()) / f"fist-scratch-{os.getuid() if hasattr(os, 'getuid') else 0}"
+
+
+class ScratchStore:
+    """
+    Byte-budgeted directory of decoded slices, shared by processes.
+
+    Keys are the slice cache keys (path, mtime_ns, size, extname, src_idx,
+    dtype); the file name is a hash of the key, so a rewritten FITS file
+    simply stops matching its old entries. Files are written under a
+    temporary name and renamed, so readers never see a partial slice.
+    Returned arrays are read-only memory maps. When the directory grows
+    past `max_bytes` the least recently written files are removed; maps
+    already open stay valid.
+    """
+
+    def __init__(self, folder=None, max_bytes=DEFAULT_SCRATCH_BYTES):
+        self.folder = Path(folder) if folder is not None else default_scratch_dir()
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return self.folder / (hashlib.sha1(repr(key).encode()).hexdigest() + ".npy")
+
+    def get(self, key):
+        try:
+            arr = np.load(self._path(key), mmap_mode="r")
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return arr
+
+    def put(self, key, arr):
+        if arr.nbytes > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp, "wb") as f:
+                np.save(f, np.ascontiguousarray(arr))
+            os.replace(tmp, path)
+        except OSError:
+            tmp.unlink(missing_ok=True)
+            return
+        self._trim()
+
+    def _trim(self):
+        entries = []
+        for p in self.folder.glob("*.npy"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, p))
+        total = sum(e[1] for e in entries)
+        for _, size, p in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self):
+        for p in self.folder.glob("*.npy"):
+            p.unlink(missing_ok=True)
+
+    def stats(self):
+        with self._lock:
+            return {"folder": str(self.folder), "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses}
@@ -1,65 +1,99 @@
 # session / folder management utilities
 
+import bisect
 from pathlib import Path
 
-from fist.core.loader import find_instrument_files, safe_get_header_value, scan_image_extensions, load_image_slice
+from fist.core.loader import find_instrument_files
+from fist.core.index import _file_index
+from fist.core.indexstore import store_for_folder
+from fist.core.watcher import FolderWatcher
+from fist.tools.arithmetic import parse_bindings
 
 # -------------------------------
 # Folder scanning helpers
 # -------------------------------
 
-def scan_folder_impl(w, instr, state):
-    folder = w["input_dir"].value
-    ftype = w["filetype"].value
-    path = Path(folder).expanduser()
+def header_sort_value(v):
+    """Sort value of a header keyword: numbers first, then text, missing last."""
+    if v is None:
+        return (2, "")
+    try:
+        return (0, float(v))
+    except (TypeError, ValueError):
+        return (1, str(v))
+
+
+def sort_files(files, kw, instr, folder):
+    """
+    Return (files, sort values) ordered by the primary-header keyword `kw`.
+    Header values come from the index, persisted per folder across sessions.
+    """
+    store = store_for_folder(folder) if instr.get("persistent_index", True) else None
+    # one header-only pass per new or changed file
+    records = _file_index.scan(files, keys=(kw,), store=store)
+    values = {
+        f: header_sort_value(records[f]["keys"].get(kw) if f in records else None)
+        for f in files
+    }
+    ordered = sorted(files, key=values.__getitem__)
+    return ordered, [values[f] for f in ordered]
+
+
+def scan_folder_params(w):
+    """Widget values needed by a folder scan (read on the document thread)."""
+    return dict(
+        folder=w["input_dir"].value,
+        ftype=w["filetype"].value,
+        kw=w["sort_key"].value.strip(),
+    )
+
+
+def collect_folder_files(params, instr):
+    """Find and sort the files of a folder scan (no widget access)."""
+    ftype, kw = params["ftype"], params["kw"]
+    path = Path(params["folder"]).expanduser()
 
     if not path.exists() or not path.is_dir():
-        w["info_state"].object = f"Folder not found: {path}"
-        return
+        return dict(error=f"Folder not found: {path}")
 
     files = find_instrument_files(path, ftype, instr)
     if not files:
-        w["info_state"].object = f"No {ftype} files in {path}"
-        return
+        return dict(error=f"No {ftype} files in {path}")
 
     files = [str(Path(f).resolve()) for f in files]
+    files, values = sort_files(files, kw, instr, path)
+    return dict(files=files, sort_values=values, kw=kw)
 
-    kw = w["sort_key"].value.strip()
 
-    def sort_key_func(f):
-        v = safe_get_header_value(f, kw)
-        if v is None:
-            return float("inf")  # push files without keyword to bottom
-        # Try numeric sorting first
-        try:
-            return float(v)
-        except:
-            return str(v)
+def apply_folder_scan(w, state, result):
+    if "error" in result:
+        w["info_state"].object = result["error"]
+        return
 
-    state["file_list"] = sorted(files, key=sort_key_func)
+    files, kw = result["files"], result["kw"]
+    state.file_list, state.sort_values = files, result["sort_values"]
+    autofetch_stop_impl(state)
 
     w["file_sel"].options = {
         Path(f).name: f
-        for f in state["file_list"]
+        for f in state.file_list
     }
 
-    if state["file_list"]:
-        w["file_sel"].value = state["file_list"][0]
+    if state.file_list:
+        w["file_sel"].value = state.file_list[0]
 
     w["file_idx"].start = 1
-    w["file_idx"].end = len(state["file_list"])
+    w["file_idx"].end = len(state.file_list)
     w["file_idx"].value = 1
 
-    state["ext_cache"].clear()
-    for f in state["file_list"][:100]:
-        state["ext_cache"][f] = scan_image_extensions(f)
-
     # arith second-file: keep "None" plus full paths
     w["arith_file"].options = {"None": "None"} | {
         Path(f).name: f
-        for f in state["file_list"]
+        for f in state.file_list
     }
     w["arith_file"].value = "None"
+    w["stack_files"].options = {Path(f).name: f for f in state.file_list}
+    w["stack_files"].value = []
 
     w["info_state"].object = f"Found {len(files)} files (sorted by: {kw})."
 
@@ -70,25 +104,14 @@ def update_extensions_impl(w, state):
         w["ext_sel"].options = []
         return
 
-    if fname not in state["ext_cache"]:
-        state["ext_cache"][fname] = scan_image_extensions(fname)
-
-    exts = state["ext_cache"][fname]
+    exts = _file_index.image_extensions(fname)
     w["ext_sel"].options = exts
 
     if exts:
         w["ext_sel"].value = exts[0]
 
     # Populate header extension list
-    try:
-        import astropy.io.fits as fits
-        with fits.open(fname, memmap=False) as hdul:
-            ext_names = [
-                h.name if h.name else f"EXT{i}"
-                for i, h in enumerate(hdul)
-            ]
-    except Exception:
-        ext_names = ["PRIMARY"]
+    ext_names = _file_index.header_extensions(fname) or ["PRIMARY"]
 
     # Update dropdown widget used for header display
     w["hdr_ext"].options = ext_names
@@ -103,47 +126,69 @@ def update_sourcelets_impl(w, instr):
         w["src_sel"].visible = False
         return
 
-    try:
-        import astropy.io.fits as fits
-        with fits.open(fname, memmap=False) as hdul:
-            for h in hdul:
-                if (
-                    h.name == ename
-                    and isinstance(h.data, np.ndarray)
-                    and h.data.ndim == 3
-                ):
-                    ns = h.data.shape[0]
-                    names = instr["sourcelets"]
-                    opts = [names.get(i, f"src{i}") for i in range(ns)]
-                    w["src_sel"].options = opts
-                    w["src_sel"].value = opts[0]
-                    w["src_sel"].visible = True
-                    return
-
-    except Exception:
-        pass
+    info = _file_index.hdu_info(fname, ename)
+    if info is not None and info["naxis"] == 3:
+        ns = info["shape"][0]
+        names = instr.get("sourcelets", {})
+        opts = [names.get(i, f"src{i}") for i in range(ns)]
+        w["src_sel"].options = opts
+        w["src_sel"].value = opts[0]
+        w["src_sel"].visible = True
+        return
 
     w["src_sel"].visible = False
 
 
-def current_arr(w, instr, state):
-    """Return arithmetic array if active, else base array."""
-    fname = w["file_sel"].value
-    ename = w["ext_sel"].value
-
-    if not fname or ename is None:
-        return None
-
-    src_idx = None
-    if w["src_sel"].visible:
-        lbl = w["src_sel"].value
-        names = instr["sourcelets"]
-        src_idx = next((i for i, n in names.items() if n == lbl), 0)
+def stack_files_impl(w):
+    """
+    Frames to stack: the displayed file and the N-1 before it in the list
+    (following autofetch), or the files picked by hand when N is 0.
+    """
+    n = w["stack_last"].value or 0
+    if n <= 0:
+        return list(w["stack_files"].value)
+    files = list(w["file_sel"].options.values())
+    if w["file_sel"].value not in files:
+        return []
+    idx = files.index(w["file_sel"].value)
+    return files[max(0, idx - n + 1):idx + 1]
 
-    if state["arith_active"] and state["arith_arr"] is not None:
-        return state["arith_arr"]
 
-    return load_image_slice(fname, ename, src_idx)
+def arith_params_impl(w):
+    """
+    Expression text and {name: (path, extension)} bindings of the image
+    arithmetic, or None when it is off. Without an expression the widgets'
+    "A op B" is used. Names may refer to a listed file (by name), a path
+    relative to the input folder, and/or an extension (default: the
+    displayed one); B is the second file unless rebound. Raises ValueError
+    on malformed bindings.
+    """
+    if not w["arith_on"].value:
+        return None
+    text = w["arith_expr"].value.strip()
+    if not text:
+        if w["arith_file"].value == "None":
+            return None
+        text = f"A {w['arith_op'].value} B"
+
+    ext = w["ext_sel"].value
+    bindings = {}
+    if w["arith_file"].value != "None":
+        bindings["B"] = (w["arith_file"].value, ext)
+
+    listed = dict(w["file_sel"].options)
+    folder = Path(w["input_dir"].value).expanduser()
+    for name, (fn, e) in parse_bindings(w["arith_names"].value).items():
+        if name == "A":
+            raise ValueError("A is the displayed image and cannot be rebound")
+        if fn is None:
+            path = w["file_sel"].value
+        elif fn in listed:
+            path = listed[fn]
+        else:
+            path = str(folder / Path(fn).expanduser())
+        bindings[name] = (path, e or ext)
+    return text, bindings
 
 
 def update_idx_impl(w):
@@ -153,32 +198,105 @@ def update_idx_impl(w):
         w["file_sel"].value = files[idx]
 
 
-def autofetch_tick_impl(w, instr):
+def autofetch_stop_impl(state):
+    """Release the folder watcher used by autofetch (a poll in progress closes it when done)."""
+    if state.watcher is not None:
+        state.watcher.close()
+    state.watcher = None
+    state.watch_key = None
+
+
+def autofetch_params(w, state):
+    """
+    Widget values and session state needed by an autofetch tick (read on
+    the document thread): the poll works on copies of the file list.
     """
-    Periodically scans the folder and updates to the latest file.
-    Runs only while autofetch is enabled.
+    return dict(
+        folder=w["input_dir"].value,
+        ftype=w["filetype"].value,
+        kw=w["sort_key"].value.strip(),
+        watcher=state.watcher,
+        watch_key=state.watch_key,
+        files=list(state.file_list),
+        sort_values=list(state.sort_values),
+    )
+
+
+def autofetch_poll(params, instr):
     """
-    folder = w["input_dir"].value
-    ftype = w["filetype"].value
-    path = Path(folder).expanduser()
+    Follow new files in the folder (no widget or session state access).
+    Returns dict(files, sort_values, watcher, watch_key) to be applied by
+    `apply_autofetch` on the document thread, or None if nothing changed.
 
-    files = find_instrument_files(path, ftype, instr)
+    The sorted file list is kept incrementally: only files reported by the
+    folder watcher (once their size is stable) are indexed and inserted.
+    Only one poll per session may run at a time.
+    """
+    ftype, kw = params["ftype"], params["kw"]
+    path = Path(params["folder"]).expanduser().resolve()
+
+    watch_key = (str(path), ftype, kw)
+    watcher = params["watcher"]
+    if watcher is None or params["watch_key"] != watch_key:
+        # (re)start watching: one indexed pass over the current folder
+        if watcher is not None:
+            watcher.close()
+        if not path.is_dir():
+            return None
+        files = [str(Path(f).resolve()) for f in find_instrument_files(path, ftype, instr)]
+        files, values = sort_files(files, kw, instr, path)
+        watcher = FolderWatcher(path, instr["filetypes"][ftype])
+        watcher.prime(files)
+    else:
+        added, removed = watcher.poll()
+        if not added and not removed:
+            return None
+
+        files, values = params["files"], params["sort_values"]
+        for f in removed:
+            if f in files:
+                i = files.index(f)
+                del files[i], values[i]
+
+        added = [str(Path(f).resolve()) for f in added]
+        store = store_for_folder(path) if instr.get("persistent_index", True) else None
+        records = _file_index.scan(added, keys=(kw,), store=store)
+        for f in added:
+            v = header_sort_value(records[f]["keys"].get(kw) if f in records else None)
+            i = bisect.bisect_right(values, v)
+            files.insert(i, f)
+            values.insert(i, v)
+
+    return dict(files=files, sort_values=values, watcher=watcher, watch_key=watch_key)
+
+
+def apply_autofetch(w, state, result):
+    """
+    Take a poll result into the session (document thread), show the updated
+    file list and select the latest file; True if the selection changed.
+    """
+    if result is None:
+        return False
+    if not w["autofetch"].value:
+        # stopped while this poll ran: drop it, and a watcher it started
+        if result["watcher"] is not state.watcher:
+            result["watcher"].close()
+        return False
+    if state.watcher is not None and state.watcher is not result["watcher"]:
+        state.watcher.close()
+    state.watcher, state.watch_key = result["watcher"], result["watch_key"]
+    state.file_list, state.sort_values = result["files"], result["sort_values"]
+
+    files = state.file_list
     if not files:
-        return
+        return False
 
-    # Sort like scan_folder does, using the predefined keyword
-    kw = w["sort_key"].value.strip()
+    w["file_sel"].options = {Path(f).name: f for f in files}
+    w["file_idx"].end = len(files)
+    w["stack_files"].options = {Path(f).name: f for f in files}
 
-    def sort_key(f):
-        v = safe_get_header_value(f, kw)
-        try:
-            return float(v)
-        except Exception:
-            return str(v) if v is not None else ""
-
-    files = sorted(map(str, map(Path.resolve, files)), key=sort_key)
     last = files[-1]
-
     if last != w["file_sel"].value:
-        w["file_sel"].options = {Path(f).name: f for f in files}
-        w["file_sel"].value = last
\ No newline at end of file
+        w["file_sel"].value = last
+        return True
+    return False
@@ -1,11 +1,35 @@
 # state parameters
+# One SessionState per browser connection; heavy immutable data (decoded
+# slices, the file index, parsed headers, stacks) lives in the shared caches
 
-_state = {
-    "file_list": [],
-    "ext_cache": {},
-    "arith_active": False,
-    "arith_arr": None,
-    "arith_nan_warning": False,
-    "transform": {"flip_x": False, "flip_y": False, "rot90": 0, "negative": False}
-}
 
+class SessionState:
+    """
+    Mutable state of one viewer session: the sorted file list, the autofetch
+    folder watcher, the last arithmetic result and the image transform.
+    """
+
+    __slots__ = (
+        "file_list", "sort_values", "watcher", "watch_key",
+        "arith_active", "arith_arr", "arith_nan_warning", "transform",
+    )
+
+    def __init__(self, transform=None):
+        self.file_list = []
+        self.sort_values = []
+        self.watcher = None
+        self.watch_key = None
+        self.arith_active = False
+        self.arith_arr = None
+        self.arith_nan_warning = False
+        self.transform = {"flip_x": False, "flip_y": False, "rot90": 0, "negative": False}
+        if transform is not None:
+            self.transform.update(transform)
+
+    @classmethod
+    def from_instrument(cls, instr):
+        """Session state starting from an instrument's default transform."""
+        T = dict(instr["transform"])
+        # instrument configs call the negative "neg"
+        T["negative"] = T.pop("neg", False)
+        return cls(transform=T)
@@ -0,0 +1,154 @@
+# out-of-core image statistics
+# Exact count/sum/mean/std/min/max and histogram percentiles accumulated
+# over row blocks, so no full-size copy of the image (or of its sorted
+# pixels) is ever made
+
+import numpy as np
+
+# size of the row blocks read at a time
+DEFAULT_CHUNK_BYTES = 32 * 1024**2
+
+# histogram bins between min and max: percentile error <= (max - min) / bins
+DEFAULT_BINS = 65536
+
+# pixels kept (evenly spread) for zscale limits
+ZSCALE_SAMPLES = 1000
+
+# images above this many bytes use the streaming engine for exact-quantile
+# scaling and region statistics (instrument option "stream_stats_mb")
+DEFAULT_STREAM_BYTES = 256 * 1024**2
+
+
+class StreamStats:
+    """
+    Running count, sum, mean, standard deviation, min and max of the finite
+    values fed through `add`, optionally weighted. Blocks are merged with
+    the pairwise (Chan et al.) update, so the result matches a single pass
+    over all pixels up to float64 rounding.
+    """
+
+    def __init__(self):
+        self.count = 0.0    # pixels, or total weight
+        self.sum = 0.0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, block, weights=None):
+        v = np.asarray(block, dtype=np.float64).ravel()
+        good = np.isfinite(v)
+        if weights is not None:
+            wts = np.asarray(weights, dtype=np.float64).ravel()
+            good &= wts > 0
+            wts = wts[good]
+        v = v[good]
+        if v.size == 0:
+            return
+
+        n = float(v.size) if weights is None else float(wts.sum())
+        s = float(v.sum()) if weights is None else float(np.dot(wts, v))
+        mean = s / n
+        d = v - mean
+        m2 = float(np.dot(d, d)) if weights is None else float(np.dot(wts, d * d))
+
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self._m2 += m2 + delta * delta * self.count * n / total
+        self.count = total
+        self.sum += s
+        self.min = min(self.min, float(v.min()))
+        self.max = max(self.max, float(v.max()))
+
+    @property
+    def std(self):
+        return float(np.sqrt(self._m2 / self.count)) if self.count > 0 else np.nan
+
+
+class HistogramQuantiles:
+    """
+    Percentiles from a fine histogram of the pixel values, with the same
+    interface as scaling.Quantiles. Memory is O(bins); any percentile is
+    within `error` (one bin width) of the exact value.
+    """
+
+    exact = False
+
+    def __init__(self, edges, counts, samples):
+        self.edges = edges
+        self.counts = counts
+        self.cum = np.cumsum(counts)
+        self.samples = samples
+        self._zscale = None
+
+    @property
+    def size(self):
+        return int(self.cum[-1]) if self.cum.size else 0
+
+    @property
+    def error(self):
+        return float(self.edges[1] - self.edges[0]) if self.edges.size > 1 else 0.0
+
+    def percentile(self, q):
+        """Percentile interpolated linearly inside its bin."""
+        if self.size == 0:
+            return np.nan
+        target = np.clip(q, 0, 100) / 100.0 * self.cum[-1]
+        i = min(int(np.searchsorted(self.cum, target)), self.counts.size - 1)
+        below = self.cum[i - 1] if i > 0 else 0
+        frac = (target - below) / self.counts[i] if self.counts[i] else 0.0
+        return float(self.edges[i] + frac * (self.edges[i + 1] - self.edges[i]))
+
+    def zscale(self):
+        """IRAF zscale limits from the pixels sampled while streaming."""
+        from fist.core.scaling import zscale_limits
+        if self._zscale is None:
+            self._zscale = zscale_limits(self.samples)
+        return self._zscale
+
+
+def array_chunks(arr, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Chunk factory over the row blocks (views) of an in-memory 2D array."""
+    rows = max(1, chunk_bytes // max(1, arr.shape[-1] * 8))
+
+    def chunks():
+        for r0 in range(0, arr.shape[0], rows):
+            yield arr[r0:r0 + rows]
+    return chunks
+
+
+def stream_stats(chunks, bins=DEFAULT_BINS, nsamples=ZSCALE_SAMPLES, npixels=None):
+    """
+    Two passes over `chunks()` (a factory returning an iterable of blocks):
+    exact moments and extrema first, then a histogram between min and max.
+    Returns (StreamStats, HistogramQuantiles). `npixels`, if known, spreads
+    the zscale sample evenly over the image.
+    """
+    stats = StreamStats()
+    samples = []
+    seen = 0
+    step = max(1, (npixels or 0) // nsamples)
+    for block in chunks():
+        stats.add(block)
+        flat = np.asarray(block).ravel()
+        # sample positions continue across blocks: every step-th pixel
+        first = (-seen) % step
+        samples.append(np.asarray(flat[first::step], dtype=np.float64))
+        seen += flat.size
+    samples = np.concatenate(samples) if samples else np.empty(0)
+    samples = samples[np.isfinite(samples)]
+
+    if stats.count == 0:
+        return stats, HistogramQuantiles(np.array([0.0, 1.0]), np.zeros(1, np.int64), samples)
+
+    lo, hi = stats.min, stats.max
+    if hi <= lo:
+        hi = lo + 1.0
+    counts = np.zeros(bins, dtype=np.int64)
+    for block in chunks():
+        v = np.asarray(block).ravel()
+        v = v[np.isfinite(v)]
+        counts += np.histogram(v, bins=bins, range=(lo, hi))[0]
+    edges = np.linspace(lo, hi, bins + 1)
+    return stats, HistogramQuantiles(edges, counts, samples)
@@ -0,0 +1,147 @@
+# timing of the hot paths
+# Spans (stage, wall time, output bytes, cache hit) go to a ring buffer that
+# the diagnostics panel summarizes and exports as JSON or Chrome trace events.
+# Disabled, a span is a shared no-op context and a traced function one flag
+# check away from a direct call
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# spans kept (oldest dropped first)
+TRACE_BUFFER_SIZE = 4096
+
+_NO_SPAN = contextlib.nullcontext()
+
+
+def result_nbytes(value):
+    """Bytes allocated for an array result (or the arrays of a tuple result); views count 0."""
+    if isinstance(value, tuple):
+        return sum(result_nbytes(v) for v in value)
+    if isinstance(value, np.ndarray):
+        return value.nbytes if value.base is None else 0
+    return 0
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "cat", "args", "t0", "nbytes", "hit")
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer, self.name, self.cat, self.args = tracer, name, cat, args
+        self.nbytes = 0
+        self.hit = False
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.cat, self.t0, time.perf_counter() - self.t0,
+                           nbytes=self.nbytes, hit=self.hit, **self.args)
+        return False
+
+
+class Tracer:
+    """
+    Ring buffer of timed spans. Each event is a dict with name, cat
+    (module), ts (s, perf_counter), dur (s), nbytes (allocated result),
+    hit (served from a cache), pid and tid; extra keyword arguments are
+    kept under "args".
+    """
+
+    def __init__(self, size=TRACE_BUFFER_SIZE, enabled=False):
+        self.enabled = enabled
+        self._events = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def span(self, name, cat, **args):
+        """Context manager timing its block; set .nbytes / .hit on it if known."""
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name, cat, args)
+
+    def record(self, name, cat, t0, dur, nbytes=0, hit=False, **args):
+        event = dict(name=name, cat=cat, ts=t0, dur=dur, nbytes=int(nbytes), hit=bool(hit),
+                     pid=os.getpid(), tid=threading.get_ident())
+        if args:
+            event["args"] = args
+        with self._lock:
+            self._events.append(event)
+
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def clear(self):
+        with self._lock:
+            self._events.clear()
+
+    def summary(self):
+        """Per span name: count, hits, total / mean / max time (ms) and bytes, slowest total first."""
+        rows = {}
+        for e in self.events():
+            r = rows.setdefault(e["name"], dict(name=e["name"], cat=e["cat"], count=0, hits=0,
+                                                total_ms=0.0, max_ms=0.0, nbytes=0))
+            ms = e["dur"] * 1e3
+            r["count"] += 1
+            r["hits"] += e["hit"]
+            r["total_ms"] += ms
+            r["max_ms"] = max(r["max_ms"], ms)
+            r["nbytes"] += e["nbytes"]
+        for r in rows.values():
+            r["mean_ms"] = r["total_ms"] / r["count"]
+        return sorted(rows.values(), key=lambda r: -r["total_ms"])
+
+    def to_json(self):
+        return json.dumps(dict(events=self.events(), summary=self.summary()), indent=1)
+
+    def to_chrome_trace(self):
+        """Trace Event Format, for chrome://tracing or ui.perfetto.dev."""
+        events = [
+            dict(name=e["name"], cat=e["cat"], ph="X", ts=e["ts"] * 1e6, dur=e["dur"] * 1e6,
+                 pid=e["pid"], tid=e["tid"],
+                 args=dict(e.get("args", {}), nbytes=e["nbytes"], hit=e["hit"]))
+            for e in self.events()
+        ]
+        return json.dumps(dict(traceEvents=events, displayTimeUnit="ms"))
+
+
+def format_trace_summary(rows):
+    """Markdown table of Tracer.summary() rows."""
+    if not rows:
+        return "No spans recorded."
+    lines = ["| span | module | calls | cached | mean ms | max ms | total ms | MB |",
+             "|---|---|---:|---:|---:|---:|---:|---:|"]
+    for r in rows:
+        lines.append(
+            f"| {r['name']} | {r['cat']} | {r['count']} | {r['hits']} | {r['mean_ms']:.1f} "
+            f"| {r['max_ms']:.1f} | {r['total_ms']:.0f} | {r['nbytes'] / 1024**2:.1f} |"
+        )
+    return "\n".join(lines)
+
+
+def traced(cat, name=None):
+    """Decorator timing every call of a function in the shared tracer."""
+    def wrap(fn):
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            if not _tracer.enabled:
+                return fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            out = fn(*args, **kwargs)
+            _tracer.record(span_name, cat, t0, time.perf_counter() - t0, nbytes=result_nbytes(out))
+            return out
+        return inner
+    return wrap
+
+
+# shared by all sessions of the server process
+_tracer = Tracer()
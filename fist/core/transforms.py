@@ -1,9 +1,16 @@
 # image array transformation operations
 
 import numpy as np
+from fist.core.tracing import traced
 
-def apply_transform(arr, T):
-    """Apply flip, rotate, negative."""
+
+@traced("transforms")
+def apply_transform(arr, T, inplace=False):
+    """
+    Apply flip, rotate, negative.
+    Flips and rotations are views; with inplace=True the negative is also
+    computed in the caller-owned input buffer instead of a new array.
+    """
     out = arr
     if T.get("flip_x"):
         out = np.fliplr(out)
@@ -13,6 +20,9 @@ def apply_transform(arr, T):
     if k != 0:
         out = np.rot90(out, k=(-k)%4)
     if T.get("negative"):
-        out = 1.0 - out
+        if inplace:
+            np.subtract(1.0, out, out=out)
+        else:
+            out = 1.0 - out
     return out
 
@@ -0,0 +1,194 @@
+# folder watcher for autofetch
+# Reports new FITS files as they arrive, using inotify on Linux and a cheap
+# directory-mtime poll elsewhere; files are only reported once their size
+# has stopped changing between two polls
+
+import ctypes
+import ctypes.util
+import fnmatch
+import os
+import struct
+import sys
+import threading
+
+# inotify constants (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_Q_OVERFLOW  = 0x00004000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+_EVENT = struct.Struct("iIII")   # wd, mask, cookie, len
+
+
+class _Inotify:
+    """Minimal non-blocking inotify reader (ctypes, no extra dependency)."""
+
+    def __init__(self, folder):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"inotify_add_watch failed for {folder}")
+
+    def changes(self):
+        """Return the set of names touched since the last call, or None on overflow."""
+        names = set()
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return names
+            pos = 0
+            while pos < len(buf):
+                _, mask, _, length = _EVENT.unpack_from(buf, pos)
+                pos += _EVENT.size
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                name = buf[pos:pos + length].rstrip(b"\0")
+                pos += length
+                if name:
+                    names.add(os.fsdecode(name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _DirPoll:
+    """Fallback: relist the folder only when its mtime changes."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._mtime = self._stat()
+
+    def _stat(self):
+        try:
+            return os.stat(self.folder).st_mtime_ns
+        except OSError:
+            return None
+
+    def changes(self):
+        mtime = self._stat()
+        if mtime == self._mtime:
+            return set()
+        self._mtime = mtime
+        return None
+
+    def close(self):
+        pass
+
+
+class FolderWatcher:
+    """
+    Track files matching `patterns` (glob patterns on the file name) in a
+    folder. `poll()` returns (added, removed) path lists; work per poll is
+    proportional to the number of changed and still-growing files.
+    `close()` may be called from any thread: during a poll it only asks the
+    polling thread to close the event source when it is done.
+    """
+
+    def __init__(self, folder, patterns, use_inotify=True):
+        self.folder = os.fspath(folder)
+        self.patterns = [patterns] if isinstance(patterns, str) else list(patterns)
+        self._known = set()
+        self._pending = {}      # path -> size seen at the previous poll
+        self._source = None
+        self._lock = threading.Lock()
+        self._polling = False
+        self._closed = False
+        if use_inotify and sys.platform.startswith("linux"):
+            try:
+                self._source = _Inotify(self.folder)
+            except OSError:
+                self._source = None
+        if self._source is None:
+            self._source = _DirPoll(self.folder)
+
+    @property
+    def backend(self):
+        return "inotify" if isinstance(self._source, _Inotify) else "poll"
+
+    def matches(self, name):
+        return any(fnmatch.fnmatch(name, p) for p in self.patterns)
+
+    def prime(self, paths):
+        """Declare already-known files, so they are not reported as new."""
+        self._known = {os.fspath(p) for p in paths}
+
+    def _listing(self):
+        try:
+            return {e.name for e in os.scandir(self.folder) if self.matches(e.name)}
+        except OSError:
+            return set()
+
+    def poll(self):
+        with self._lock:
+            if self._closed:
+                return [], []
+            self._polling = True
+        try:
+            return self._poll()
+        finally:
+            with self._lock:
+                self._polling = False
+                closing = self._closed
+            if closing:
+                # close() was called meanwhile and left the source to us
+                self._source.close()
+
+    def _poll(self):
+        names = self._source.changes()
+        removed = []
+
+        if names is None:
+            # unknown extent of change: compare against a fresh listing
+            present = {os.path.join(self.folder, n) for n in self._listing()}
+            removed = sorted(p for p in self._known if p not in present)
+            self._known.difference_update(removed)
+            for p in present:
+                if p not in self._known:
+                    self._pending.setdefault(p, None)
+        else:
+            for name in names:
+                if not self.matches(name):
+                    continue
+                p = os.path.join(self.folder, name)
+                if os.path.exists(p):
+                    if p not in self._known:
+                        self._pending.setdefault(p, None)
+                elif p in self._known:
+                    self._known.discard(p)
+                    removed.append(p)
+
+        # debounce: report a file once its size is unchanged since last poll
+        added = []
+        for p, last in list(self._pending.items()):
+            try:
+                size = os.stat(p).st_size
+            except OSError:
+                del self._pending[p]
+                continue
+            if size > 0 and size == last:
+                del self._pending[p]
+                self._known.add(p)
+                added.append(p)
+            else:
+                self._pending[p] = size
+
+        return sorted(added), removed
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._polling:
+                return
+        self._source.close()
@@ -0,0 +1,224 @@
+# background execution of file I/O and image computation
+# Keeps astropy reads and numpy work off the Bokeh event loop; results are
+# handed back to the document thread, and superseded requests are dropped
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import panel as pn
+from panel.io.state import set_curdoc
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+
+# renders run at most once per display frame (60 Hz)
+RENDER_FRAME_MS = 16
+
+
+class TaskRunner:
+    """
+    Thread pool with one "latest request wins" slot per channel.
+
+    `submit(channel, fn, ...)` runs fn in the pool and calls on_done(result)
+    on the document thread, or on_error(exception) if fn raised; exceptions
+    of current requests are always logged with their traceback. A newer
+    submit on the same channel cancels the older request if it has not
+    started yet, and discards its result if it has. Outside a Bokeh server
+    session everything runs synchronously.
+    """
+
+    def __init__(self, max_workers=DEFAULT_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fist-io")
+        self._lock = threading.Lock()
+        self._generation = {}   # (doc id, channel) -> int
+        self._futures = {}      # (doc id, channel) -> Future
+
+    @staticmethod
+    def _served_doc():
+        doc = pn.state.curdoc
+        if doc is None or doc.session_context is None:
+            return None
+        return doc
+
+    def busy(self, channel, doc=None):
+        """True if the last request on `channel` (current document) is still pending."""
+        doc = doc if doc is not None else pn.state.curdoc
+        fut = self._futures.get((id(doc), channel))
+        return fut is not None and not fut.done()
+
+    def is_current(self, channel, generation, doc=None):
+        doc = doc if doc is not None else pn.state.curdoc
+        return self._generation.get((id(doc), channel)) == generation
+
+    def submit(self, channel, fn, *args, on_done=None, on_error=None):
+        """
+        Run fn(*args) in the background. Returns the request generation,
+        which fn may compare via `is_current` to stop early.
+        """
+        doc = self._served_doc()
+        key = (id(doc), channel)
+        with self._lock:
+            generation = self._generation.get(key, 0) + 1
+            self._generation[key] = generation
+            prev = self._futures.pop(key, None)
+        if prev is not None:
+            prev.cancel()
+
+        if doc is None:
+            try:
+                result = fn(*args)
+            except Exception as e:
+                if on_error is None:
+                    raise
+                on_error(e)
+                return generation
+            if on_done is not None:
+                on_done(result)
+            return generation
+
+        fut = self._pool.submit(fn, *args)
+        with self._lock:
+            self._futures[key] = fut
+        fut.add_done_callback(partial(self._deliver, doc, key, generation, on_done, on_error))
+        return generation
+
+    def _deliver(self, doc, key, generation, on_done, on_error, fut):
+        if fut.cancelled() or self._generation.get(key) != generation:
+            return
+        exc = fut.exception()
+        if exc is not None:
+            log.error("Background task on channel %r failed", key[1],
+                      exc_info=(type(exc), exc, exc.__traceback__))
+            cb = partial(on_error, exc) if on_error is not None else None
+        else:
+            cb = partial(on_done, fut.result()) if on_done is not None else None
+        if cb is None:
+            return
+
+        def apply():
+            # a newer request may have been made while this one was queued
+            if self._generation.get(key) == generation:
+                cb()
+
+        with set_curdoc(doc):
+            pn.state.execute(apply, schedule=True)
+
+    def forget(self, doc):
+        """Drop the channels of a closed session, cancelling what is still queued."""
+        with self._lock:
+            keys = [k for k in self._generation if k[0] == id(doc)]
+            futures = [self._futures.pop(k, None) for k in keys]
+            for k in keys:
+                # any result still on its way is then discarded by _deliver
+                self._generation.pop(k)
+        for fut in futures:
+            if fut is not None:
+                fut.cancel()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class Debouncer:
+    """
+    Calls fn() once, `delay_ms` after the last of a burst of triggers
+    (e.g. keystrokes). Call from the document thread; outside a Bokeh
+    server session fn runs immediately.
+    """
+
+    def __init__(self, fn, delay_ms):
+        self.fn = fn
+        self.delay_ms = delay_ms
+        self._pending = None    # (doc, timeout callback)
+
+    def __call__(self, *args):
+        doc = TaskRunner._served_doc()
+        if doc is None:
+            self.fn()
+            return
+        self.cancel()
+        self._pending = (doc, doc.add_timeout_callback(self._fire, self.delay_ms))
+
+    def _fire(self):
+        self._pending = None
+        self.fn()
+
+    def cancel(self):
+        if self._pending is not None:
+            doc, cb = self._pending
+            self._pending = None
+            try:
+                doc.remove_timeout_callback(cb)
+            except ValueError:
+                # already ran
+                pass
+
+
+class RenderScheduler:
+    """
+    Coalesces render requests: any number of `request()` calls between two
+    frames run fn() once, at most every `frame_ms`, and not while `busy()`
+    reports the previous render still computing (fn then runs once it is
+    done, with the latest widget values). Counts requested and executed
+    renders. Call from the document thread; outside a Bokeh server session
+    fn runs immediately.
+    """
+
+    def __init__(self, fn, frame_ms=RENDER_FRAME_MS, busy=None):
+        self.fn = fn
+        self.frame_ms = frame_ms
+        self.busy = busy
+        self.requested = 0
+        self.executed = 0
+        self._pending = None    # (doc, timeout callback)
+        self._last = 0.0        # time of the last run (s)
+
+    def request(self, *args):
+        """Ask for a render; extra arguments (e.g. watcher events) are ignored."""
+        self.requested += 1
+        doc = TaskRunner._served_doc()
+        if doc is None:
+            self._run()
+            return
+        if self._pending is not None:
+            # already due: this request is served by it
+            return
+        wait = self._last + self.frame_ms / 1000 - time.monotonic()
+        self._schedule(doc, max(0, int(wait * 1000)))
+
+    def _schedule(self, doc, delay_ms):
+        self._pending = (doc, doc.add_timeout_callback(self._fire, delay_ms))
+
+    def _fire(self):
+        doc, _ = self._pending
+        if self.busy is not None and self.busy():
+            # keep coalescing until the running render is done
+            self._schedule(doc, self.frame_ms)
+            return
+        self._pending = None
+        self._run()
+
+    def _run(self):
+        self._last = time.monotonic()
+        self.executed += 1
+        self.fn()
+
+    def cancel(self):
+        if self._pending is not None:
+            doc, cb = self._pending
+            self._pending = None
+            try:
+                doc.remove_timeout_callback(cb)
+            except ValueError:
+                pass
+
+    def stats(self):
+        return {"requested": self.requested, "executed": self.executed}
+
+
+# shared by all sessions of the server process
+_runner = TaskRunner()
@@ -6,69 +6,257 @@ from astropy.io import fits
 
 from scipy.ndimage import map_coordinates
 
+from fist.core.streamstats import (
+    StreamStats, HistogramQuantiles, DEFAULT_STREAM_BYTES, DEFAULT_CHUNK_BYTES, DEFAULT_BINS
+)
+from fist.core.tracing import traced
+
 # Cuts 
 
-def compute_diagonal_cut(arr, x1, y1, x2, y2, npts=500):
-    xs = np.linspace(x1, x2, npts)
-    ys = np.linspace(y1, y2, npts)
-    coords = np.vstack([ys, xs])  # (row=y, col=x)
+def compute_cuts(arr, lines, width=1, step=1.0):
+    """
+    Sample many straight cuts through an image in one interpolation call.
+
+    `lines` is a sequence of (x1, y1, x2, y2) in pixel coordinates. Each
+    cut gets one sample every `step` pixels along its length (at least
+    two), and with width > 1 every sample is the mean of `width` points
+    spaced one pixel apart across the line. Returns a list of (dist, vals)
+    per line.
+    """
+    lines = np.asarray(lines, dtype=float).reshape(-1, 4)
+    if lines.shape[0] == 0:
+        return []
+    x1, y1, x2, y2 = lines.T
+    dx, dy = x2 - x1, y2 - y1
+    length = np.hypot(dx, dy)
+
+    # samples per line follow its length; t in [0, 1] along every line
+    npts = np.maximum(2, np.ceil(length / step).astype(int) + 1)
+    starts = np.concatenate([[0], np.cumsum(npts)[:-1]])
+    line_of = np.repeat(np.arange(len(lines)), npts)
+    t = (np.arange(npts.sum()) - starts[line_of]) / (npts - 1)[line_of]
+
+    xs = x1[line_of] + t * dx[line_of]
+    ys = y1[line_of] + t * dy[line_of]
+
+    if width > 1:
+        # unit normals, and `width` offsets centred on the line
+        with np.errstate(invalid="ignore", divide="ignore"):
+            nx = np.where(length > 0, -dy / length, 0.0)[line_of]
+            ny = np.where(length > 0, dx / length, 0.0)[line_of]
+        offsets = (np.arange(width) - (width - 1) / 2)[:, None]
+        xs = xs + offsets * nx
+        ys = ys + offsets * ny
+
+    coords = np.stack([ys.ravel(), xs.ravel()])  # (row=y, col=x)
     vals = map_coordinates(arr, coords, order=1, mode="nearest")
-    dist = np.linspace(0, np.hypot(x2-x1, y2-y1), npts)
-    return dist, vals
-
-def update_cut_plot(arr, x1, y1, x2, y2, cut_source):
-    if arr is None:
-        cut_source.data=dict(x=[],y=[])
-        return
-    h,w = arr.shape
-    x1 = np.clip(x1, 0, w-1)
-    x2 = np.clip(x2, 0, w-1)
-    y1 = np.clip(y1, 0, h-1)
-    y2 = np.clip(y2, 0, h-1)
-    dist, vals = compute_diagonal_cut(arr, x1, y1, x2, y2)
-    cut_source.data = dict(x=dist, y=vals)
+    if width > 1:
+        vals = vals.reshape(width, -1).mean(axis=0)
+
+    dist = t * length[line_of]
+    return list(zip(np.split(dist, starts[1:]), np.split(vals, starts[1:])))
+
+def clip_cut(shape, x1, y1, x2, y2):
+    """Clip cut endpoints to the image."""
+    h, w = shape
+    return (float(np.clip(x1, 0, w-1)), float(np.clip(y1, 0, h-1)),
+            float(np.clip(x2, 0, w-1)), float(np.clip(y2, 0, h-1)))
+
+@traced("analysis")
+def compute_cut_profile(arr, x1, y1, x2, y2, width=1):
+    """Clip the cut endpoints to the image and sample it (no Bokeh access)."""
+    return compute_cuts(arr, [clip_cut(arr.shape, x1, y1, x2, y2)], width=width)[0]
 
 # Region
 
-def compute_region_stats(arr, mask):
+REGION_SHAPES = ("Circle", "Square")
+
+def _circle_quadrant(a, b, r):
     """
-    Return a two-row aligned monospace table inside a Markdown code block.
+    Signed area of a circle of radius r (centred on the origin) inside the
+    rectangle spanned by the origin and (a, b).
+    """
+    sign = np.sign(a) * np.sign(b)
+    a = np.minimum(np.abs(a), r)
+    b = np.minimum(np.abs(b), r)
+
+    def S(t):
+        # integral of sqrt(r^2 - x^2) from 0 to t, for 0 <= t <= r
+        return 0.5 * (t * np.sqrt(np.maximum(r*r - t*t, 0)) + r*r * np.arcsin(np.minimum(t / r, 1)))
+
+    # below x = m the circle is above y = b, so that strip is a rectangle
+    m = np.minimum(a, np.sqrt(np.maximum(r*r - b*b, 0)))
+    return sign * (b * m + S(a) - S(m))
+
+def circle_overlap(x0, x1, y0, y1, cx, cy, r):
+    """Exact area of the circle (cx, cy, r) inside the rectangles [x0, x1] x [y0, y1]."""
+    r = np.maximum(r, 1e-12)
+    x0, x1, y0, y1 = x0 - cx, x1 - cx, y0 - cy, y1 - cy
+    return (_circle_quadrant(x1, y1, r) - _circle_quadrant(x0, y1, r)
+            - _circle_quadrant(x1, y0, r) + _circle_quadrant(x0, y0, r))
+
+def _region_boxes(shape, regions):
+    """Region parameters and bounding boxes (pixel indices, clipped to the image)."""
+    h, w = shape
+    kind = np.array([k for k, *_ in regions])
+    x, y, d = np.array([r[1:] for r in regions], dtype=float).reshape(-1, 3).T
+    d = np.maximum(d, 0)
+    circle = kind == "Circle"
+
+    i0 = np.clip(np.floor(np.where(circle, x - d, x)), 0, w).astype(int)
+    j0 = np.clip(np.floor(np.where(circle, y - d, y)), 0, h).astype(int)
+    i1 = np.clip(np.ceil(x + d), 0, w).astype(int)
+    j1 = np.clip(np.ceil(y + d), 0, h).astype(int)
+    return circle, x, y, d, (i0, i1, j0, j1)
+
+def _box_weights(circle, x, y, d, rows, cols, i1, j1):
+    """
+    Fractional weights of pixel grids rows (N, ky, 1) x cols (N, 1, kx) for
+    N regions; pixels past a region's box end (i1, j1) get weight 0.
+    """
+    c3 = lambda v: v[:, None, None]
+    wts = np.zeros((len(circle), rows.shape[1], cols.shape[2]))
+    if circle.any():
+        wts[circle] = circle_overlap(cols[circle], cols[circle] + 1, rows[circle], rows[circle] + 1,
+                                     c3(x[circle]), c3(y[circle]), c3(d[circle]))
+    sq = ~circle
+    if sq.any():
+        ox = np.clip(np.minimum(cols[sq] + 1, c3(x[sq] + d[sq])) - np.maximum(cols[sq], c3(x[sq])), 0, 1)
+        oy = np.clip(np.minimum(rows[sq] + 1, c3(y[sq] + d[sq])) - np.maximum(rows[sq], c3(y[sq])), 0, 1)
+        wts[sq] = ox * oy
+    wts[~((cols < c3(i1)) & (rows < c3(j1)))] = 0
+    return wts
+
+def region_weights(shape, regions):
+    """
+    Bounding boxes and fractional pixel weights of many regions at once.
+
+    `regions` is a sequence of (kind, x, y, d): a circle of radius d centred
+    on (x, y), or a square [x, x+d] x [y, y+d]. Pixel (i, j) covers
+    [i, i+1] x [j, j+1], as drawn on the image, and is weighted by the
+    fraction of it inside the region. All boxes are padded to a common
+    size; returns (rows, cols, weights) with shapes (N, ky, 1), (N, 1, kx)
+    and (N, ky, kx), rows/cols clipped to the image.
+    """
+    h, w = shape
+    circle, x, y, d, (i0, i1, j0, j1) = _region_boxes(shape, regions)
+    kx = max(1, int((i1 - i0).max(initial=0)))
+    ky = max(1, int((j1 - j0).max(initial=0)))
+
+    cols = (i0[:, None] + np.arange(kx))[:, None, :]     # (N, 1, kx)
+    rows = (j0[:, None] + np.arange(ky))[:, :, None]     # (N, ky, 1)
+    wts = _box_weights(circle, x, y, d, rows, cols, i1, j1)
+
+    return np.minimum(rows, max(h - 1, 0)), np.minimum(cols, max(w - 1, 0)), wts
+
+STAT_KEYS = ("area", "sum", "mean", "std", "min", "median", "max")
+
+def region_stats(arr, regions, stream_bytes=DEFAULT_STREAM_BYTES):
+    """
+    Area-weighted statistics of many regions in one vectorized pass, read
+    from their bounding boxes only. Non-finite pixels are left out.
+
+    Returns a dict of arrays, one value per region: area (pixels), sum,
+    mean, std, min, median (weighted) and max; NaN for empty regions.
+
+    If the padded boxes would need more than `stream_bytes` of weights,
+    each region is instead streamed in row blocks (see region_stats_streamed).
+    """
+    if len(regions) == 0:
+        return {k: np.array([]) for k in STAT_KEYS}
+
+    _, _, _, _, (i0, i1, j0, j1) = _region_boxes(arr.shape, regions)
+    padded = len(regions) * int((i1 - i0).max(initial=0)) * int((j1 - j0).max(initial=0)) * 8
+    if stream_bytes is not None and padded > stream_bytes:
+        per_region = [region_stats_streamed(arr, r, chunk_bytes=stream_bytes // 8) for r in regions]
+        return {k: np.array([st[k] for st in per_region]) for k in STAT_KEYS}
+
+    rows, cols, wts = region_weights(arr.shape, regions)
+    n = wts.shape[0]
+    vals = np.asarray(arr[rows, cols], dtype=float).reshape(n, -1)
+    wts = wts.reshape(n, -1)
+    good = np.isfinite(vals) & (wts > 0)
+    wts = np.where(good, wts, 0)
+    vals0 = np.where(good, vals, 0)
+
+    area = wts.sum(axis=1)
+    total = (wts * vals0).sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / area
+        std = np.sqrt((wts * (vals0 - mean[:, None])**2).sum(axis=1) / area)
+    vmin = np.where(good, vals, np.inf).min(axis=1)
+    vmax = np.where(good, vals, -np.inf).max(axis=1)
+
+    # weighted median: first value whose cumulative weight reaches half
+    order = np.argsort(np.where(good, vals, np.inf), axis=1)
+    sv = np.take_along_axis(vals, order, axis=1)
+    cw = np.cumsum(np.take_along_axis(wts, order, axis=1), axis=1)
+    med = sv[np.arange(n), np.argmax(cw >= 0.5 * area[:, None], axis=1)]
+
+    empty = area <= 0
+    for a in (mean, std, vmin, vmax, med):
+        a[empty] = np.nan
+    return dict(area=area, sum=total, mean=mean, std=std, min=vmin, median=med, max=vmax)
+
+def region_stats_streamed(arr, region, chunk_bytes=DEFAULT_CHUNK_BYTES, bins=DEFAULT_BINS):
+    """
+    Statistics of one (large) region, computed over row blocks of its
+    bounding box: exact area, sum, mean, std, min and max, and the median
+    from a weighted histogram (within (max - min) / bins).
     """
+    circle, x, y, d, (i0, i1, j0, j1) = _region_boxes(arr.shape, [region])
+    cols = np.arange(i0[0], i1[0])[None, None, :]
+    step = max(1, chunk_bytes // max(1, cols.size * 8))
+
+    def blocks():
+        for r0 in range(j0[0], j1[0], step):
+            rows = np.arange(r0, min(r0 + step, j1[0]))[None, :, None]
+            wts = _box_weights(circle, x, y, d, rows, cols, i1, j1)[0]
+            yield arr[r0:r0 + rows.shape[1], i0[0]:i1[0]], wts
 
-    data = arr[mask]
+    stats = StreamStats()
+    for vals, wts in blocks():
+        stats.add(vals, wts)
+    if stats.count <= 0:
+        return dict(area=0.0, sum=0.0, mean=np.nan, std=np.nan, min=np.nan, median=np.nan, max=np.nan)
 
+    hi = stats.max if stats.max > stats.min else stats.min + 1.0
+    counts = np.zeros(bins)
+    for vals, wts in blocks():
+        good = np.isfinite(vals) & (wts > 0)
+        counts += np.histogram(vals[good], bins=bins, range=(stats.min, hi), weights=wts[good])[0]
+    median = HistogramQuantiles(np.linspace(stats.min, hi, bins + 1), counts, None).percentile(50)
+
+    return dict(area=stats.count, sum=stats.sum, mean=stats.mean, std=stats.std,
+                min=stats.min, median=median, max=stats.max)
+
+def format_region_stats(stats, i=0):
+    """
+    Return a two-row aligned monospace table inside a Markdown code block.
+    """
     # Empty region
-    if data.size == 0:
+    if not stats["area"][i] > 0:
         table = (
             "```\n"
-            "Count     Sum     |  Mean      Std      |  Min      Median    Max\n"
-            "0         0       |    -         -      |    -        -        -\n"
+            "Area      Sum       |  Mean       Std       |  Min        Median     Max\n"
+            "0         0         |    -          -       |    -          -          -\n"
             "```"
         )
         return table
 
-    # Compute numbers
-    N = data.size
-    S = np.sum(data)
-    mean = np.mean(data)
-    std  = np.std(data)
-    vmin = np.min(data)
-    med  = np.median(data)
-    vmax = np.max(data)
-
     # Format with fixed-width columns using Python formatting
     header = (
-        "Count     Sum       |  Mean       Std       |  Min        Median     Max"
+        "Area      Sum       |  Mean       Std       |  Min        Median     Max"
     )
 
     values = (
-        f"{N:<9d} "
-        f"{S:<9.4g} |  "
-        f"{mean:<9.4g}  "
-        f"{std:<9.4g} |  "
-        f"{vmin:<9.4g}  "
-        f"{med:<9.4g}  "
-        f"{vmax:<9.4g}"
+        f"{stats['area'][i]:<9.4g} "
+        f"{stats['sum'][i]:<9.4g} |  "
+        f"{stats['mean'][i]:<9.4g}  "
+        f"{stats['std'][i]:<9.4g} |  "
+        f"{stats['min'][i]:<9.4g}  "
+        f"{stats['median'][i]:<9.4g}  "
+        f"{stats['max'][i]:<9.4g}"
     )
 
     # Wrap in a Markdown code block so spacing is preserved
@@ -76,3 +264,7 @@ def compute_region_stats(arr, mask):
 
     return table
 
+@traced("analysis")
+def compute_region_stats(arr, region, stream_bytes=DEFAULT_STREAM_BYTES):
+    """Statistics table of one (kind, x, y, d) region (see region_stats)."""
+    return format_region_stats(region_stats(arr, [region], stream_bytes=stream_bytes))
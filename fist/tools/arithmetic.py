@@ -1,20 +1,196 @@
 # simple arithmetic functions for FITS image arrays
+# Expressions such as "(A - B) / C * 1.2" are parsed and checked once, then
+# evaluated one block of rows at a time into reused block-sized buffers, so
+# no full-size temporaries are allocated
+
+import ast
+import functools
+import re
 
 import numpy as np
 
-def compute_arithmetic(arr1, arr2, op):
-    if arr1.shape != arr2.shape:
-        return None, False
-    with np.errstate(divide='ignore', invalid='ignore'):
-        if op == "+":
-            out = arr1 + arr2
-        elif op == "-":
-            out = arr1 - arr2
-        elif op in ("×", "x", "*"):
-            out = arr1 * arr2
-        elif op == "/":
-            out = arr1 / arr2
-        else:
-            out = arr1.copy()
-    return out, not np.isfinite(out).all()
+# rows of scratch work per block, in bytes of one operand
+EXPRESSION_BLOCK_BYTES = 4 * 1024**2
+
+# operators and functions allowed in expressions
+_BINOPS = {
+    ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+    ast.Div: np.true_divide, ast.Pow: np.power,
+}
+_UNARYOPS = {ast.USub: np.negative, ast.UAdd: np.positive}
+EXPRESSION_FUNCS = {
+    "sqrt": np.sqrt, "log": np.log, "log10": np.log10, "exp": np.exp, "abs": np.absolute,
+}
+
+# "B = bias.fits", "C = [RED_CCD]", "D = flat.fits[SCI]"
+_BINDING = re.compile(r"^\s*([A-Za-z_]\w*)\s*=\s*([^\[\]]*?)\s*(?:\[\s*([^\]]+?)\s*\])?\s*$")
+
+
+class Expression:
+    """
+    A validated arithmetic expression compiled to a list of numpy calls.
+
+    `names` are the image names it uses (sorted); `text` is its canonical
+    form, equal for expressions that differ only in spacing or brackets.
+    """
+
+    def __init__(self, text, program, names):
+        self.text = text
+        self.program = program
+        self.names = names
+
+    def __repr__(self):
+        return f"Expression({self.text!r})"
+
+    def _eval_block(self, blocks, pool):
+        """Evaluate on one block; `blocks` maps names to (read-only) blocks."""
+        stack = []      # (value, owned): owned arrays are scratch buffers
+
+        def take(like):
+            return pool.pop() if pool else np.empty_like(like)
+
+        # constants are folded at compile time: every operation has an array operand
+        for op, arg in self.program:
+            if op == "const":
+                stack.append((arg, False))
+            elif op == "name":
+                stack.append((blocks[arg], False))
+            elif op == "unary":
+                v, owned = stack.pop()
+                out = v if owned else take(v)
+                arg(v, out=out)
+                stack.append((out, True))
+            else:   # binary
+                (b, b_owned), (a, a_owned) = stack.pop(), stack.pop()
+                if a_owned:
+                    out = a
+                elif b_owned:
+                    out = b
+                else:
+                    out = take(a if np.ndim(a) else b)
+                arg(a, b, out=out)
+                # the operand not reused as output goes back to the pool
+                if a_owned and b_owned:
+                    pool.append(b)
+                stack.append((out, True))
+        return stack.pop()
+
+    def evaluate(self, images, dtype=np.float32, block_bytes=EXPRESSION_BLOCK_BYTES):
+        """
+        Evaluate on full images (dict name -> 2D array of one shape), a block
+        of rows at a time. Returns (result, nan_warning) with nan_warning True
+        if any result pixel is not finite, or (None, False) if the images
+        are missing or do not have the same shape.
+        """
+        if any(n not in images or images[n] is None for n in self.names):
+            return None, False
+        shapes = {np.shape(images[n]) for n in self.names}
+        if len(shapes) != 1:
+            return None, False
+        (shape,) = shapes
+        if len(shape) != 2:
+            return None, False
+
+        out = np.empty(shape, dtype=dtype)
+        rows = max(1, block_bytes // max(1, shape[1] * out.itemsize))
+        pool = []
+        nonfinite = False
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            for r0 in range(0, shape[0], rows):
+                # names are read through block views; results go to scratch
+                blocks = {n: np.asarray(images[n][r0:r0 + rows], dtype=dtype) for n in self.names}
+                if pool and pool[0].shape != blocks[self.names[0]].shape:
+                    # shorter last block
+                    pool = []
+                v, owned = self._eval_block(blocks, pool)
+                dst = out[r0:r0 + rows]
+                dst[...] = v
+                if owned:
+                    pool.append(v)
+                if not nonfinite and not np.isfinite(dst).all():
+                    nonfinite = True
+        return out, nonfinite
+
+
+def _compile(node, names):
+    """Postfix program of an expression node; constant sub-expressions are folded."""
+    if isinstance(node, ast.Expression):
+        return _compile(node.body, names)
+
+    if isinstance(node, ast.Constant):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise ValueError(f"Only numbers are allowed as constants, not {node.value!r}")
+        return [("const", float(node.value))]
+
+    if isinstance(node, ast.Name):
+        if node.id in EXPRESSION_FUNCS:
+            raise ValueError(f"'{node.id}' is a function: write {node.id}(...)")
+        names.add(node.id)
+        return [("name", node.id)]
+
+    if isinstance(node, ast.BinOp):
+        op = _BINOPS.get(type(node.op))
+        if op is None:
+            raise ValueError(f"Operator '{type(node.op).__name__}' is not allowed")
+        operands = [_compile(node.left, names), _compile(node.right, names)]
+        kind = "binary"
+    elif isinstance(node, ast.UnaryOp):
+        op = _UNARYOPS.get(type(node.op))
+        if op is None:
+            raise ValueError(f"Operator '{type(node.op).__name__}' is not allowed")
+        operands = [_compile(node.operand, names)]
+        kind = "unary"
+    elif isinstance(node, ast.Call):
+        fn = node.func.id if isinstance(node.func, ast.Name) else None
+        if fn not in EXPRESSION_FUNCS or len(node.args) != 1 or node.keywords:
+            raise ValueError(
+                f"Unknown function call. Available: {', '.join(sorted(EXPRESSION_FUNCS))} "
+                "(one argument each)"
+            )
+        op = EXPRESSION_FUNCS[fn]
+        operands = [_compile(node.args[0], names)]
+        kind = "unary"
+    else:
+        raise ValueError(f"'{type(node).__name__}' is not allowed in expressions")
+
+    if all(len(o) == 1 and o[0][0] == "const" for o in operands):
+        with np.errstate(all="ignore"):
+            return [("const", float(op(*[o[0][1] for o in operands])))]
+    return [ins for o in operands for ins in o] + [(kind, op)]
+
+
+@functools.lru_cache(maxsize=128)
+def compile_expression(text):
+    """
+    Parse and check an expression once: numbers, image names, + - * / **,
+    unary minus and the functions in EXPRESSION_FUNCS. Raises ValueError
+    with a readable message otherwise.
+    """
+    try:
+        tree = ast.parse(text.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Syntax error in expression: {e.msg}") from None
+    names = set()
+    program = _compile(tree, names)
+    if not names:
+        raise ValueError("The expression uses no image")
+    return Expression(ast.unparse(tree), tuple(program), tuple(sorted(names)))
+
+
+def parse_bindings(text):
+    """
+    Parse image names bound to files and/or extensions, separated by
+    commas, semicolons or new lines: "B = bias.fits, C = [RED_CCD],
+    D = flat.fits[SCI]". Returns {name: (file or None, extension or None)};
+    raises ValueError on a malformed entry.
+    """
+    out = {}
+    for item in re.split(r"[,;\n]", text or ""):
+        if not item.strip():
+            continue
+        m = _BINDING.match(item)
+        if m is None or not (m.group(2) or m.group(3)):
+            raise ValueError(f"Cannot read binding '{item.strip()}' (expected NAME = file[EXT])")
+        out[m.group(1)] = (m.group(2) or None, m.group(3))
+    return out
 
@@ -1,51 +1,143 @@
 # header handling tools
+# Headers are parsed once per (file, mtime, size, extension) into cards with
+# a lowercase search index; the pane shows one page of the (filtered) cards
 
-def apply_header_filter_impl(w):
-    full_text = w["hdr_full_text"]
-    query = w["hdr_search"].value.strip().lower()
+import functools
+import html
 
-    if not query:
-        filtered = full_text
-    else:
-        lines = [
-            line for line in full_text.split("\n")
-            if query in line.lower()
-        ]
-        filtered = "\n".join(lines) if lines else "No matches found."
+from fist.core.cache import file_signature
+from fist.core.tracing import traced
+
+# header lines shown per page
+HEADER_PAGE_LINES = 200
+
+# search waits for this pause in typing before filtering
+SEARCH_DEBOUNCE_MS = 150
+
+# page changes (e.g. holding the arrow) are drawn once they settle
+PAGE_DEBOUNCE_MS = 100
+
+# "key:", "value:" or "comment:" at the start of a query restricts the search
+SEARCH_FIELDS = ("key", "value", "comment")
+
+
+class HeaderCards:
+    """
+    The (key, value, comment) cards of one HDU header, their formatted
+    lines, and lowercase copies of each field as the search index.
+    Instances are shared through the cache: do not modify.
+    """
+
+    def __init__(self, cards):
+        self.cards = [(k, v, c) for k, v, c in cards]
+        self.lines = [f"{k:<20} = {v}" + (f" / {c}" if c else "") for k, v, c in self.cards]
+        self.lower = [line.lower() for line in self.lines]
+        self.fields = {
+            name: [str(card[i]).lower() for card in self.cards]
+            for i, name in enumerate(SEARCH_FIELDS)
+        }
+
+    def __len__(self):
+        return len(self.lines)
+
+    def search(self, query, within=None, field=None):
+        """
+        Indices of the cards containing `query` (lowercase) in their line,
+        or only in `field` ("key", "value" or "comment"), among `within`.
+        """
+        text = self.lower if field is None else self.fields[field]
+        idx = range(len(text)) if within is None else within
+        return [i for i in idx if query in text[i]]
+
+
+def parse_header_query(query):
+    """(field or None, text) of a lowercase search query such as "key:naxis"."""
+    field, sep, text = query.partition(":")
+    if sep and field.strip() in SEARCH_FIELDS:
+        return field.strip(), text.strip()
+    return None, query
+
+
+@functools.lru_cache(maxsize=64)
+def _cached_cards(sig, ext):
+    import astropy.io.fits as fits
+    # only the headers up to `ext` are parsed; data is never read
+    with fits.open(sig[0], memmap=True, lazy_load_hdus=True) as hdul:
+        return HeaderCards((c.keyword, c.value, c.comment) for c in hdul[ext].header.cards)
 
-    w["hdr_pane"].object = (
+
+@traced("header")
+def read_header_cards(fname, ext):
+    """Parsed header of one HDU, cached while the file is unchanged (no widget access)."""
+    return _cached_cards(file_signature(fname), ext)
+
+
+def _header_html(lines):
+    return (
         "<pre style='white-space: pre; font-family: monospace;'>"
-        + filtered +
+        + html.escape("\n".join(lines)) +
         "</pre>"
     )
 
 
-def update_header_impl(w):
-    fname = w["file_sel"].value
-    ext = w["hdr_ext"].value
+@traced("header")
+def show_header_page(w):
+    """Render the current page of the matching header lines."""
+    cards, matches = w["hdr_cards"], w["hdr_matches"]
+    if cards is None:
+        return
+    if not matches:
+        w["hdr_pane"].object = _header_html(["No matches found."])
+        w["hdr_info"].object = f"0 of {len(cards)} lines"
+        return
+
+    npages = -(-len(matches) // HEADER_PAGE_LINES)
+    page = min(max(1, w["hdr_page"].value or 1), npages)
+    w["hdr_page"].end = npages
+    lo = (page - 1) * HEADER_PAGE_LINES
+    hi = min(lo + HEADER_PAGE_LINES, len(matches))
+    w["hdr_pane"].object = _header_html([cards.lines[i] for i in matches[lo:hi]])
+    w["hdr_info"].object = f"lines {lo + 1}-{hi} of {len(matches)}" + (
+        f" ({len(cards)} in header)" if len(matches) != len(cards) else "")
 
-    if not fname or ext is None:
+
+def apply_header_filter_impl(w):
+    cards = w["hdr_cards"]
+    if cards is None:
         return
+    query = (w["hdr_search"].value_input or "").strip().lower()
 
-    import astropy.io.fits as fits
-    try:
-        with fits.open(fname) as hdul:
-            hdr = hdul[ext].header
-    except Exception as e:
-        w["hdr_pane"].object = f"<pre>Error loading header: {e}</pre>"
+    prev = w["hdr_query"]
+    if query == prev:
         return
+    field, text = parse_header_query(query)
+    prev_field, prev_text = parse_header_query(prev) if prev is not None else (None, None)
+    if not text:
+        matches = list(range(len(cards)))
+    elif prev_text and field == prev_field and text.startswith(prev_text):
+        # typing on: only the cards that matched so far can still match
+        matches = cards.search(text, within=w["hdr_matches"], field=field)
+    else:
+        matches = cards.search(text, field=field)
 
-    # build text exactly like FITS header formatting
-    lines = [f"{k:<20} = {v}" for k, v in hdr.items()]
-    text = "\n".join(lines) + "\n\n"
+    w["hdr_query"], w["hdr_matches"] = query, matches
+    if w["hdr_page"].value != 1:
+        # the page watcher draws it
+        w["hdr_page"].value = 1
+    else:
+        show_header_page(w)
 
-    # store raw text for later searching
-    w["hdr_full_text"] = text
 
-    w["hdr_pane"].object = (
-        "<pre style='white-space: pre; font-family: monospace;'>"
-        + text +
-        "</pre>"
-    )
+def show_header_cards(w, cards):
+    if cards is w["hdr_cards"]:
+        # same header (cached): the page on show is still right
+        return
+    w["hdr_cards"] = cards
+    w["hdr_query"] = None
+    apply_header_filter_impl(w)
+
 
-    apply_header_filter_impl(w)
\ No newline at end of file
+def show_header_error(w, e):
+    w["hdr_cards"] = None
+    w["hdr_info"].object = ""
+    w["hdr_pane"].object = f"<pre>Error loading header: {html.escape(str(e))}</pre>"
@@ -0,0 +1,167 @@
+# headless quick-look rendering
+# Renders FITS frames to PNG/WebP thumbnails with the same scaling,
+# transforms and colormaps as the viewer, without a browser
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from fist.core.cache import SliceCache
+from fist.core.loader import find_instrument_files, load_image_slice, scan_image_extensions
+from fist.core.scaling import percentile_clip, image_quantiles
+from fist.core.transforms import apply_transform
+from fist.core.pyramid import downsample2
+from fist.core.display import rgba_uint32_from_norm
+
+# output image formats (file suffixes) understood by PIL
+RENDER_FORMATS = ("png", "webp")
+
+# a batch reads every frame once: nothing worth keeping between frames
+_no_cache = SliceCache(max_bytes=0)
+
+
+def render_settings(instr, **overrides):
+    """
+    Rendering settings from an instrument configuration, as the viewer
+    starts with; keyword arguments that are not None override them.
+    """
+    scaling = instr["default_scaling"]
+    T = dict(instr["transform"])
+    # the viewer's transform state calls the negative "negative"
+    T["negative"] = T.pop("neg", False)
+    settings = dict(
+        ext=None, plane=0,
+        vmin=scaling["vmin"], vmax=scaling["vmax"],
+        gamma=scaling["gamma"], contrast=scaling["contrast"],
+        stretch=scaling["stretch"], quantiles=scaling["quantiles"],
+        transform=T,
+        cmap=instr["default_cmap"], lut_size=instr["lut_size"],
+        dtype=instr["working_dtype"],
+        max_size=1024, quality=90,
+    )
+    settings.update({k: v for k, v in overrides.items() if v is not None})
+    return settings
+
+
+def render_frame(fn, s):
+    """
+    Scaled, transformed and colormapped frame as an (h, w, 3) uint8 array,
+    top row first, halved until its longest side fits s["max_size"].
+    Returns None if the file has no readable image.
+    """
+    ext = s["ext"]
+    if ext is None:
+        exts = scan_image_extensions(fn)
+        if not exts:
+            return None
+        ext = exts[0]
+
+    arr = load_image_slice(fn, ext, s["plane"], cache=_no_cache, dtype=s["dtype"])
+    if arr is None and s["plane"] is not None:
+        # a 2D image has no planes to choose from
+        arr = load_image_slice(fn, ext, None, cache=_no_cache, dtype=s["dtype"])
+    if arr is None:
+        return None
+
+    arr01 = percentile_clip(
+        arr, s["vmin"], s["vmax"], s["gamma"],
+        stretch=s["stretch"], contrast=s["contrast"], dtype=s["dtype"],
+        quantiles=image_quantiles(arr, s["quantiles"]),
+    )
+    del arr
+    np.nan_to_num(arr01, copy=False, nan=0.0)
+    arr01 = apply_transform(arr01, s["transform"], inplace=True)
+
+    while s["max_size"] and max(arr01.shape) > s["max_size"]:
+        arr01 = downsample2(arr01)
+
+    # the viewer draws row 0 at the bottom, image files at the top
+    rgba = rgba_uint32_from_norm(np.flipud(arr01), s["cmap"], lut_size=s["lut_size"])
+    return rgba.view(np.uint8).reshape(rgba.shape + (4,))[..., :3]
+
+
+def output_path(fn, out_dir, fmt):
+    return Path(out_dir) / f"{Path(fn).stem}.{fmt}"
+
+
+def is_up_to_date(fn, out):
+    """True if `out` exists and is newer than the frame it was made from."""
+    try:
+        return os.stat(out).st_mtime_ns >= os.stat(fn).st_mtime_ns
+    except OSError:
+        return False
+
+
+def render_file(fn, out, s):
+    """
+    Render one frame to `out` (written atomically). Returns (status,
+    seconds) with status "ok" or an error message.
+    """
+    from PIL import Image
+
+    t0 = time.perf_counter()
+    try:
+        img = render_frame(fn, s)
+        if img is None:
+            return "no image data", time.perf_counter() - t0
+        tmp = Path(out).with_name(f".{Path(out).name}.tmp")
+        fmt = Path(out).suffix[1:].upper()
+        opts = dict(quality=s["quality"]) if fmt == "WEBP" else {}
+        Image.fromarray(np.ascontiguousarray(img)).save(tmp, format=fmt, **opts)
+        os.replace(tmp, out)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}", time.perf_counter() - t0
+    return "ok", time.perf_counter() - t0
+
+
+def render_folder(folder, out_dir, instr, filetype, fmt="png", workers=None,
+                  force=False, settings=None, report=print):
+    """
+    Render every file of `filetype` in `folder` into `out_dir`, skipping
+    files whose output is newer than the frame. Frames are spread over a
+    pool of `workers` processes (default: one per core).
+
+    Returns a summary dict with counts, wall time and throughput.
+    """
+    if fmt not in RENDER_FORMATS:
+        raise ValueError(f"Unknown format '{fmt}'. Available: {RENDER_FORMATS}")
+    settings = settings if settings is not None else render_settings(instr)
+    workers = workers or os.cpu_count() or 1
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    files = find_instrument_files(folder, filetype, instr)
+    jobs = []
+    for fn in files:
+        out = output_path(fn, out_dir, fmt)
+        if force or not is_up_to_date(fn, out):
+            jobs.append((fn, out))
+
+    rendered, failed, cpu = 0, 0, 0.0
+    t0 = time.perf_counter()
+    if jobs:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            results = pool.map(render_file, *zip(*jobs), [settings] * len(jobs),
+                               chunksize=max(1, len(jobs) // (4 * workers)))
+            for (fn, out), (status, seconds) in zip(jobs, results):
+                cpu += seconds
+                if status == "ok":
+                    rendered += 1
+                else:
+                    failed += 1
+                    report(f"  {Path(fn).name}: {status}")
+    wall = time.perf_counter() - t0
+
+    return dict(
+        files=len(files), rendered=rendered, failed=failed,
+        skipped=len(files) - len(jobs),
+        workers=min(workers, max(1, len(jobs))),
+        wall=wall,
+        fps=rendered / wall if wall > 0 else 0.0,
+        # frames per second of worker time, i.e. what one core sustains
+        fps_per_core=rendered / cpu if cpu > 0 else 0.0,
+    )
@@ -0,0 +1,186 @@
+# multi-frame stacking for FITS image arrays
+# Combines any number of frames (mean, median or sigma-clipped mean) one
+# band of rows at a time, so memory stays bounded however many frames are
+# stacked; bands are spread over a thread pool
+
+import os
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from fist.core.cache import SliceCache, file_signature
+from fist.core.index import _file_index
+from fist.core.loader import iter_plane_rows
+
+# combinations understood by stack_frames
+STACK_METHODS = ("mean", "median", "sigclip")
+
+# rejection threshold and iterations of the sigma-clipped mean
+DEFAULT_SIGMA = 3.0
+SIGCLIP_ITERS = 5
+
+# pixels (all frames) held at once by each worker
+DEFAULT_STACK_CHUNK_BYTES = 64 * 1024**2
+
+# FITS files a stack keeps open at once, over all its bands; a memory-mapped
+# file takes two descriptors, so this stays well under the usual limit of
+# 1024 per process
+MAX_OPEN_FILES = 128
+
+# finished stacks, shared by all sessions
+DEFAULT_STACK_CACHE_BYTES = 512 * 1024**2
+
+_stack_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="fist-stack")
+_stack_cache = SliceCache(max_bytes=DEFAULT_STACK_CACHE_BYTES)
+
+
+def combine_block(cube, method, sigma=DEFAULT_SIGMA):
+    """
+    Combine a (frames, rows, cols) block along the frame axis, ignoring
+    NaNs. `cube` is owned by the caller and may be modified.
+    """
+    with warnings.catch_warnings():
+        # pixels that are NaN in every frame stay NaN
+        warnings.simplefilter("ignore", RuntimeWarning)
+        if method == "mean":
+            return np.nanmean(cube, axis=0)
+        if method == "median":
+            return np.nanmedian(cube, axis=0)
+
+        # iterative rejection around the median, then mean of the survivors;
+        # the spread is the scaled median absolute deviation, since a plain
+        # std of a few frames is inflated by the very outlier to reject
+        for _ in range(SIGCLIP_ITERS):
+            med = np.nanmedian(cube, axis=0)
+            std = 1.4826 * np.nanmedian(np.abs(cube - med), axis=0)
+            with np.errstate(invalid="ignore"):
+                bad = np.abs(cube - med) > sigma * std
+            if not bad.any():
+                break
+            cube[bad] = np.nan
+        return np.nanmean(cube, axis=0)
+
+
+def _read_rows(fn, ename, src_idx, b0, b1):
+    """Rows [b0, b1) of one frame, opening and closing the file."""
+    reader = iter_plane_rows(fn, ename, src_idx, rows=b1 - b0, start=b0, stop=b1)
+    try:
+        block = next(reader, (None, None))[1]
+    finally:
+        reader.close()
+    if block is None or len(block) != b1 - b0:
+        raise ValueError(f"Cannot read rows {b0}-{b1} of {fn}")
+    return block
+
+
+def _stack_band(files, ename, src_idx, method, sigma, rows, r0, r1, out, keep_open=True):
+    """
+    Stack rows [r0, r1) of every frame into out[r0:r1], `rows` rows at a
+    time. With keep_open=False only one file is open at a time: each frame
+    is reopened for every block, slower but bounded in file descriptors.
+    Raises ValueError if a frame cannot supply all the rows.
+    """
+    if not keep_open:
+        for b0 in range(r0, r1, rows):
+            b1 = min(b0 + rows, r1)
+            cube = np.stack([_read_rows(fn, ename, src_idx, b0, b1) for fn in files])
+            out[b0:b1] = combine_block(cube, method, sigma)
+        return
+
+    readers = [iter_plane_rows(fn, ename, src_idx, rows=rows, start=r0, stop=r1) for fn in files]
+    done = 0
+    try:
+        # zip stops at the first frame to run out of rows: counted below
+        for blocks in zip(*readers):
+            b0 = blocks[0][0]
+            cube = np.stack([b for _, b in blocks])
+            out[b0:b0 + cube.shape[1]] = combine_block(cube, method, sigma)
+            done += cube.shape[1]
+    finally:
+        for r in readers:
+            r.close()
+    if done != r1 - r0:
+        raise ValueError(f"Frames supplied only {done} of rows {r0}-{r1}")
+
+
+def stack_frames(files, ename, src_idx, method="mean", sigma=DEFAULT_SIGMA, dtype=np.float32,
+                 chunk_bytes=DEFAULT_STACK_CHUNK_BYTES, pool=_stack_pool):
+    """
+    Stack one plane of several FITS files, read straight from disk.
+
+    Each worker of `pool` handles a band of rows and holds at most
+    `chunk_bytes` of pixels (all frames) at a time. At most MAX_OPEN_FILES
+    files are open at once: fewer bands run in parallel for many frames,
+    and beyond that number each band opens the frames one by one. Returns
+    the stack as `dtype`, or None if the files do not all have a readable
+    plane of the same shape.
+    """
+    if method not in STACK_METHODS:
+        raise ValueError(f"Unknown stack method '{method}'. Available: {STACK_METHODS}")
+    if not files:
+        return None
+
+    shapes = set()
+    for fn in files:
+        info = _file_index.hdu_info(fn, ename)
+        if info is None or info["naxis"] not in (2, 3):
+            return None
+        # cubes must all hold the plane, or their readers yield no rows
+        if info["naxis"] == 3 and not 0 <= (src_idx or 0) < info["shape"][0]:
+            return None
+        shapes.add(tuple(info["shape"][-2:]))
+    if len(shapes) != 1:
+        return None
+    h, w = shapes.pop()
+
+    out = np.empty((h, w), dtype=dtype)
+    rows = max(1, chunk_bytes // max(1, len(files) * w * 8))
+    nbands = min(getattr(pool, "_max_workers", 1), -(-h // rows))
+    keep_open = len(files) <= MAX_OPEN_FILES
+    if keep_open:
+        # every band holds all the frames open
+        nbands = max(1, min(nbands, MAX_OPEN_FILES // len(files)))
+    edges = np.linspace(0, h, nbands + 1).astype(int)
+
+    futures = [
+        pool.submit(_stack_band, files, ename, src_idx, method, sigma, rows, r0, r1, out, keep_open)
+        for r0, r1 in zip(edges[:-1], edges[1:]) if r1 > r0
+    ]
+    try:
+        for fut in futures:
+            fut.result()
+    except Exception:
+        for fut in futures:
+            fut.cancel()
+        return None
+    return out
+
+
+def stack_key(files, ename, src_idx, method, sigma, dtype):
+    """
+    Cache key of a stack: the (paths, mtimes, sizes) of its frames, as the
+    slice cache keys single files, plus the stacking parameters.
+    Raises OSError if a frame cannot be stat'ed.
+    """
+    paths, mtimes, sizes = zip(*(file_signature(fn) for fn in files))
+    return (paths, mtimes, sizes, ename, src_idx, method, float(sigma), np.dtype(dtype).str)
+
+
+def load_stack(files, ename, src_idx, method="mean", sigma=DEFAULT_SIGMA, dtype=np.float32,
+               cache=_stack_cache):
+    """
+    Stack of `files` (see stack_frames), served from `cache` while none of
+    the frames changed on disk. Returns None if the frames cannot be stacked.
+    """
+    files = tuple(files)
+    if not files:
+        return None
+    try:
+        key = stack_key(files, ename, src_idx, method, sigma, dtype)
+    except OSError:
+        return None
+
+    return cache.get_or_load(
+        key, lambda: stack_frames(files, ename, src_idx, method, sigma, dtype=dtype)
+    )